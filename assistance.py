@@ -1,36 +1,360 @@
 import os
+import sys
 import json
 import time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import re
+import threading
+import heapq
+try:
+    import pybase64 as base64  # SIMD-accelerated, same API as the stdlib module
+except ImportError:
+    import base64
+import hashlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from datetime import datetime
 # Import the interface provided by your teammates
 #from peripheral_test import Camera, Speaker, Microphone
 from peripheral import MockCamera, Speaker, Microphone
 
+try:
+    import cv2
+    import numpy as np
+except ImportError:
+    cv2 = None  # Change detection falls back to comparing the raw image data
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # Falls back to the stdlib json module
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None  # The history snapshot is then written uncompressed
+
 # Load API Key
 load_dotenv()
 API_KEY = os.getenv("OPENAI_API_KEY")
 
+CHAT_COMPLETIONS_URL = "https://api.openai.com/v1/chat/completions"
+RESPONSES_URL = "https://api.openai.com/v1/responses"
+
+# Brain / hand tiering: silent monitoring ticks go to the cheap model and are
+# only escalated to the main model if it reports anything other than no change.
+MAIN_MODEL = "gpt-4o"
+MONITOR_MODEL = "gpt-4o-mini"
+REQUEST_TIMEOUT = (5, 60)  # Seconds: (connect, read). A dead connection fails fast.
+
+# Seconds listen() may run past its timeout while the user is mid-phrase
+MAX_PHRASE_WAIT = 10
+
+# Rate limits and transient server errors are retried with exponential backoff
+# (honouring Retry-After) instead of failing the turn.
+API_RETRY = Retry(
+    total=3,
+    backoff_factor=0.5,
+    status_forcelist=[429, 500, 502, 503, 504],
+    read=0,  # A POST that timed out mid-read may already have been served
+    allowed_methods=["POST"],
+    raise_on_status=False
+)
+
+# --- SYSTEM PROMPT ---
+# Static and identical every turn (the per-turn context goes in the user message)
+SYSTEM_PROMPT = """
+        You are a Smart Cooking Assistant.
+
+        ### LANGUAGE PROTOCOL ###
+        - CRITICAL: All content in "speech_output" MUST be in Traditional Chinese (Taiwan/繁體中文).
+        - Internal JSON values (status, next_state, timer_name, thought_process) MUST remain in English.
+        
+        OUTPUT JSON FORMAT:
+        {
+            "thought_process": "1. Analyze image (describe strictly what you see). 2. Compare to goal. 3. Formulate response.",
+            "speech_output": "Text to speak (empty string if strictly monitoring with no update)",
+            "status": "MONITORING_NO_CHANGE" | "INSTRUCTION_UPDATE" | "USER_INTERACTION",
+            "next_state": "Exact string name of the next state",
+            "timer_name": "Name (e.g. 'Pasta') or null",
+            "timer_duration": "Seconds (int) or null"
+        }
+
+        ### STATE TRANSITION ENFORCEMENT (HIGHEST PRIORITY) ###
+        1. You are a State Machine. Your current state is 'current_state' in the user's turn context.
+        2. You MUST select 'next_state' ONLY from that context's 'valid_next_states' list.
+        3. DO NOT invent new states. DO NOT switch state if the user did not agree.
+
+        ### VISUAL REASONING PROTOCOL (Use 'thought_process' for this) ###
+        When asked to judge the state of food (e.g., cut size, doneness):
+        1. FIRST, describe strictly what you see in the image (e.g., "I see a whole fillet," or "I see large chunks").
+        2. THEN, compare it to the goal state.
+        3. ONLY THEN give your verdict in 'speech_output'.
+
+        INSTRUCTIONS:
+        
+        1. SETUP PHASE (States: START -> INGREDIENT_SCAN -> RECIPE_CONFIRMATION -> INSTRUCTION_OVERVIEW):
+           - State: START
+             * Goal: Greet and ask to see ingredients.
+             * ACTION: If user says "Hi", "Ready" or agrees, MUST output "next_state": "INGREDIENT_SCAN" immediately. Do NOT wait for image here.
+           - State: INGREDIENT_SCAN
+             * Goal: Analyze image, identify ingredients, propose dish.
+           - State: RECIPE_CONFIRMATION
+             * Goal: Wait for agreement. Move to INSTRUCTION_OVERVIEW.
+           - State: INSTRUCTION_OVERVIEW
+             * Goal: List steps. Ask "Ready to cook?". Move to ACTIVE_COOKING.
+
+        2. ACTIVE COOKING PHASE (State: ACTIVE_COOKING):
+           
+           ### SUB-CATEGORY 1: IF 'user_voice' IS EMPTY (Visual Monitoring Mode)
+           1. CASE (General Monitoring): 
+              CRITICAL: You are a PASSIVE OBSERVER. Do NOT check in. Do NOT ask if they are done.
+              Even if the step looks finished visually, keep waiting.
+              Output status "MONITORING_NO_CHANGE" and empty speech_output.
+           2. CASE (Visual Mistake / Safety Hazard): 
+              ONLY speak if the user is making a specific error (e.g., burning food, cutting dangerously).
+              Explain the error clearly.
+
+           ### SUB-CATEGORY 2: IF 'user_voice' IS NOT EMPTY (Interaction Mode)
+           1. CASE (User says "Ok", "Got it", "Sure", "I see"):
+              This is ACKNOWLEDGMENT. Do NOT move to the next step. 
+              Output: "speech_output": "" (or very brief confirmation), "status": "MONITORING_NO_CHANGE".
+           2. CASE (User explicitly confirms COMPLETION or asks for NEXT):
+              (e.g., "I'm done", "Next step", "What's next?", "Ready").
+              ACTION: Explain the NEXT step. Set status="INSTRUCTION_UPDATE".
+           3. CASE (User asks visual judgment question): 
+              (e.g. "Is it small enough?", "Is this done?").
+              ACTION: Check 'thought_process' logic.
+              - If the food looks exactly the same as the raw ingredient: Say "It doesn't look diced yet. It looks like a whole piece."
+              - If you can't see it clearly: Say "I can't see the salmon clearly. Can you bring it closer?"
+              - Only say "Yes" if you clearly see distinct small pieces.
+           4. CASE (User asks general question):
+              Answer the question. Remain on current step.
+
+        3. GENERAL RULES:
+           - "timer_name/duration": If user starts a timed task, provide details. Confirm verbally.
+"""
+
+# Without debug output the reasoning is not written out: 'thought_process' is
+# roughly half of every reply's tokens and is only ever printed to the console
+SYSTEM_PROMPT_NO_THOUGHT = (
+    SYSTEM_PROMPT
+    .replace("(status, next_state, timer_name, thought_process)", "(status, next_state, timer_name)")
+    .replace('            "thought_process": "1. Analyze image (describe strictly what you see). 2. Compare to goal. 3. Formulate response.",\n', "")
+    .replace("(Use 'thought_process' for this)", "(Reason silently, do NOT output it)")
+    .replace("ACTION: Check 'thought_process' logic.", "ACTION: Follow the visual reasoning protocol.")
+)
+
+# Reply budgets: a silent monitoring tick answers in a line, but setup states
+# and spoken questions can carry a whole step list in Traditional Chinese
+LONG_REPLY_STATES = ("INGREDIENT_SCAN", "RECIPE_CONFIRMATION", "INSTRUCTION_OVERVIEW")
+
+# --- Rolling Memory ---
+# Only the last MAX_RECENT_TURNS user/assistant pairs are sent verbatim;
+# anything older is folded into a running summary by a cheaper model.
+# Compaction waits until twice that many turns have piled up, so it runs
+# once every MAX_RECENT_TURNS turns instead of after every turn.
+MAX_RECENT_TURNS = 6
+SUMMARY_TRIGGER_TURNS = 2 * MAX_RECENT_TURNS
+SUMMARY_MODEL = "gpt-4o-mini"
+SUMMARY_PROMPT = (
+    "Summarize this cooking session so far in ≤150 tokens, preserving chosen dish, "
+    "completed steps, active timers, and user preferences."
+)
+
+# --- Local Monitoring ---
+# Mean absolute difference (0-255) between 64x64 grayscale thumbnails above
+# which a silent ACTIVE_COOKING frame is worth sending to GPT.
+FRAME_DIFF_THRESHOLD = 4.0
+LOCAL_NO_CHANGE_RESPONSE = {
+    "thought_process": "Local check: scene unchanged since the last analyzed frame.",
+    "speech_output": "",
+    "status": "MONITORING_NO_CHANGE",
+    "next_state": "ACTIVE_COOKING",
+    "timer_name": None,
+    "timer_duration": None
+}
+
+# START needs no reasoning: whatever the user says, the next step is the scan
+START_RESPONSE = {
+    "speech_output": "好的，請把食材拿到鏡頭前。",
+    "status": "USER_INTERACTION",
+    "next_state": "INGREDIENT_SCAN",
+    "timer_name": None,
+    "timer_duration": None
+}
+
+# --- Timers ---
+TIMER_BATCH_WINDOW = 0.5  # Seconds
+
+# --- Debug Log ---
+LOG_FLUSH_INTERVAL = 2.0  # Seconds
+
+# --- Images ---
+IMAGE_URL_PREFIX = "data:image/jpeg;base64,"
+
+# --- Response Cache ---
+# Replies keyed by (state, user_voice, frame hash, previous reply)
+RESPONSE_CACHE_SIZE = 128
+
+# --- JSON ---
+# orjson on the per-turn paths (request bodies, replies, SSE events, the log)
+def json_bytes(obj):
+    """Compact UTF-8 JSON for request bodies."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def json_text(obj):
+    """Compact JSON as a str."""
+    return json_bytes(obj).decode("utf-8")
+
+def json_loads(data):
+    """Parses JSON from str or bytes. Errors are json.JSONDecodeError either way."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+# --- Streaming Speech ---
+# speech_output of a partially received JSON reply (the string may still be open)
+SPEECH_FIELD_RE = re.compile(r'"speech_output"\s*:\s*"((?:[^"\\]|\\.)*)("?)')
+SENTENCE_END_RE = re.compile(r"[。！？!?\n]|\.(?=\s)")
+
+class SpeechStreamer:
+    """
+    Collects a streamed JSON reply and hands every finished sentence of its
+    speech_output to `speak` as soon as it arrives.
+    """
+    def __init__(self, speak):
+        self.speak = speak
+        self.content = ""
+        self.spoken = 0  # Characters of speech_output already spoken
+        self.closed = False  # The speech_output string has ended
+        self._search_from = 0  # Text before this cannot start the speech_output key
+
+    def _partial_speech(self):
+        match = SPEECH_FIELD_RE.search(self.content, self._search_from)
+        if not match:
+            # Leave room for a key cut in half by the chunk boundary
+            self._search_from = max(0, len(self.content) - 32)
+            return ""
+        self._search_from = match.start()
+        try:
+            speech = json_loads(f'"{match.group(1)}"')
+        except json.JSONDecodeError:
+            return ""  # Cut in the middle of an escape sequence, wait for more
+        self.closed = bool(match.group(2))
+        return speech
+
+    def _say(self, text):
+        text = text.strip()
+        if text:
+            self.speak(text)
+
+    def feed(self, delta):
+        self.content += delta
+        if self.closed:
+            return  # Only the remaining fields are still arriving
+        speech = self._partial_speech()
+
+        # Once the string is closed the last sentence needs no terminator
+        end = len(speech) if self.closed else None
+        if end is None:
+            for match in SENTENCE_END_RE.finditer(speech, self.spoken):
+                end = match.end()
+        if end:
+            self._say(speech[self.spoken:end])
+            self.spoken = end
+
+    def finish(self):
+        """Speaks whatever is left and returns the full reply text."""
+        try:
+            speech = json_loads(self.content).get("speech_output") or ""
+        except (json.JSONDecodeError, AttributeError):
+            return self.content
+        self._say(speech[self.spoken:])
+        self.spoken = len(speech)
+        return self.content
+
+class ReplyTruncated(Exception):
+    """The reply hit its token limit, so its JSON is cut off."""
+
 class State:
-    def __init__(self, name, description, valid_next_states, requires_image=False):
+    __slots__ = ("name", "description", "valid_next_states", "requires_image", "handler", "_prompt_head")
+
+    def __init__(self, name, description, valid_next_states, requires_image=False, handler=None):
         self.name = name
         self.description = description
         self.valid_next_states = valid_next_states
         self.requires_image = requires_image
+        # Bound method running one tick of the state; returns the next state name
+        self.handler = handler
+
+        # The static half of every turn context, serialized once
+        self._prompt_head = (
+            f'{{"current_state": {json.dumps(name)}, '
+            f'"goal": {json.dumps(description)}, '
+            f'"valid_next_states": {json.dumps(valid_next_states)}, '
+        )
 
 class CookingAssistant:
-    def __init__(self, debug=True):
+    def __init__(self, debug=True, stateful=False, stream=True, visual_memory=False):
         self.api_key = API_KEY
         self.history = []
         self.debug = debug
-        self.active_timers = [] # List to store dicts: {'name': str, 'end_time': float}
+
+        # Debug log: every history entry is appended as one JSON line
+        # (history_log.json gets a full snapshot when the session ends)
+        self._log_file = open("history_log.jsonl", "ab") if debug else None
+        self._last_log_flush = 0.0
+
+        # Running summary of turns that fell out of the recent window
+        self.summary = ""
+        self._history_lock = threading.Lock()
+        self._summarizing = False
+        self._last_reply = None  # (history entry, parsed JSON) of the newest assistant message
+        self._turn_count = 0  # User messages so far; survives summaries and merges
+        self._frame_turns = {}  # id(entry) -> (entry, turn number) of entries holding a frame
+
+        # History entries whose images are still kept (see _prune_history_images)
+        self._cooking_images = deque()
+        self._latest_other_image = None
+
+        # Stateful mode: the conversation lives on OpenAI's side (Responses API),
+        # so each turn only uploads the new user message. self.history is then
+        # kept for the debug log and for replaying if the chain expires.
+        self.stateful = stateful
+        self.last_response_id = None
+
+        # Stream replies and start speaking on the first finished sentence
+        self.stream = stream
+
+        # Only the current frame is sent inline unless visual memory is on,
+        # in which case the cooking frames kept by the Amnesia strategy go too
+        self.visual_memory = visual_memory
+
+        self.active_timers = [] # Min-heap of (end_time, name) tuples
+
+        # --- Networking / Concurrency ---
+        # One keep-alive session so every turn reuses the TCP/TLS connection
+        self.session = requests.Session()
+        self.session.headers.update({
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {self.api_key}"
+        })
+        # Chat, summary and escalation calls can overlap: keep a few sockets warm
+        self.session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=API_RETRY))
+        # Lets camera capture overlap with listening
+        self._executor = ThreadPoolExecutor(max_workers=3)
         
         # --- Hardware Initialization ---
-        self.speaker = Speaker()
-        self.camera = MockCamera()
         self.mic = Microphone()
+        # The speaker pauses the mic while it talks, so it does not hear itself
+        self.speaker = Speaker(microphone=self.mic)
+        self.camera = MockCamera()
         
         # --- State Definitions ---
         self.states = {
@@ -38,25 +362,29 @@ class CookingAssistant:
                 name="START",
                 description="Initial state. Introduce yourself and ask the human to show the ingredients.",
                 valid_next_states=["INGREDIENT_SCAN"],
-                requires_image=False
+                requires_image=False,
+                handler=self._handle_start
             ),
             "INGREDIENT_SCAN": State(
                 name="INGREDIENT_SCAN",
                 description="Analyze the image to identify ingredients. Propose a dish based on them.",
                 valid_next_states=["RECIPE_CONFIRMATION", "INGREDIENT_SCAN"],
-                requires_image=True
+                requires_image=True,
+                handler=self._handle_reactive
             ),
             "RECIPE_CONFIRMATION": State(
                 name="RECIPE_CONFIRMATION",
                 description="Negotiate with the human. If the human agrees to the dish, move to INSTRUCTION_OVERVIEW. If no, propose another dish.",
                 valid_next_states=["RECIPE_CONFIRMATION", "INSTRUCTION_OVERVIEW"],
-                requires_image=True
+                requires_image=True,
+                handler=self._handle_reactive
             ),
             "INSTRUCTION_OVERVIEW": State(
                 name="INSTRUCTION_OVERVIEW",
                 description="Give a high-level overview of the instructions. If the user agrees to start, move to ACTIVE_COOKING",
                 valid_next_states=["INSTRUCTION_OVERVIEW", "ACTIVE_COOKING"],
-                requires_image=False
+                requires_image=False,
+                handler=self._handle_reactive
             ),
             "ACTIVE_COOKING": State(
                 name="ACTIVE_COOKING",
@@ -69,7 +397,8 @@ class CookingAssistant:
                 5. When the entire recipe is done, transition to FINISHED.
                 """,
                 valid_next_states=["ACTIVE_COOKING", "FINISHED"],
-                requires_image=True
+                requires_image=True,
+                handler=self._handle_active_cooking
             ),
             "FINISHED": State(
                 name="FINISHED",
@@ -80,91 +409,138 @@ class CookingAssistant:
         }
         
         self.current_state_name = "START"
+        self.last_frame_small = None  # Thumbnail of the last frame GPT analyzed
+        # (base64 frame, derived value) of the newest frame, matched by identity
+        self._last_image_url = (None, None)
+        self._last_thumbnail = (None, None)
+        self._response_cache = OrderedDict()
+        self._history_json = {}  # id(entry) -> (entry, content, layout, serialized bytes)
+
+        # --- SYSTEM PROMPT ---
+        # Byte-identical on every call, so the API's prompt cache always hits the prefix
+        self._system_msg = {"role": "system", "content": SYSTEM_PROMPT if debug else SYSTEM_PROMPT_NO_THOUGHT}
+        self._system_msg_bytes = json_bytes(self._system_msg)
+        # The thought process needs the extra room
+        self.max_tokens = 500 if debug else 200  # Silent monitoring ticks
+        self.long_max_tokens = 1000 if debug else 700  # LONG_REPLY_STATES and spoken turns
+        # Logged in place of skipped monitoring calls; must match the reply format asked for
+        self._local_no_change_reply = json_text(
+            LOCAL_NO_CHANGE_RESPONSE if debug
+            else {k: v for k, v in LOCAL_NO_CHANGE_RESPONSE.items() if k != "thought_process"}
+        )
 
     def speak(self, text):
+        # Queued on the Speaker's worker thread: perception keeps running while it talks
         print(f"🤖 AI: {text}")
-        while self.speaker.is_playing():
-            time.sleep(0.1)
         self.speaker.play_text(text)
 
-    def listen(self, timeout=5):
+    def listen(self, timeout=5, quiet_timeout=None):
         """
-        Polls Microphone.has_text() for a duration.
+        Waits on the Microphone's phrase queue for a duration.
         Returns text string or empty string.
+        - quiet_timeout: give up early if no voice at all was heard by then.
+        - The window stays open (up to MAX_PHRASE_WAIT more seconds) while a
+          phrase is still coming in, so it is not pushed to the next tick.
         """
         start_time = time.time()
-        while time.time() - start_time < timeout:
-            if self.mic.has_text():
-                text = self.mic.read_text()
-                if text:
-                    print(f"👤 User: {text}")
-                    return text
-            time.sleep(0.1)
+        heard_voice = False
+        while True:
+            # Wakes up as soon as a phrase is queued; the slice only paces the VAD checks
+            text = self.mic.read_text(timeout=0.1)
+            if text:
+                print(f"👤 User: {text}")
+                return text
+
+            elapsed = time.time() - start_time
+            voice_active = self.mic.voice_active()
+            heard_voice = heard_voice or voice_active
+
+            if quiet_timeout is not None and elapsed >= quiet_timeout and not heard_voice:
+                break
+            if elapsed >= timeout and (not voice_active or elapsed >= timeout + MAX_PHRASE_WAIT):
+                break
         return ""
 
     def capture_image(self):
         return self.camera.capture()
 
-    def _save_history(self):
+    def _save_history(self, entry):
+        """Appends the new entry to the debug log, flushing at most every LOG_FLUSH_INTERVAL."""
+        if self._log_file is None:
+            return
+        try:
+            self._log_file.write(json_bytes(entry) + b"\n")
+            now = time.time()
+            if now - self._last_log_flush >= LOG_FLUSH_INTERVAL:
+                self._log_file.flush()
+                self._last_log_flush = now
+        except Exception:
+            pass
+
+    def _close_history_log(self):
+        """Closes the append-only log and writes one full snapshot of the final history."""
+        if self._log_file is None:
+            return
+        try:
+            self._log_file.close()
+            # Compact JSON (pretty-print it with --pretty when reading it)
+            data = json_bytes(self.history)
+            path = "history_log.json"
+            if zstandard is not None:
+                data = zstandard.ZstdCompressor(level=1).compress(data)
+                path += ".zst"
+            with open(path, "wb") as f:
+                f.write(data)
+        except Exception:
+            pass
+
+    def _strip_image(self, entry):
+        """Removes the image of a history entry, leaving a placeholder."""
+        # Rebuild content list EXCLUDING the image_url item
+        new_content = [item for item in entry["content"] if item.get("type") != "image_url"]
+
+        # Add a placeholder so the AI knows an image used to be there
+        new_content.append({
+            "type": "text", 
+            "text": "[System Note: Older image data stripped to save memory]"
+        })
+
+        entry["content"] = new_content
+        self._frame_turns.pop(id(entry), None)
         if self.debug:
-            try:
-                with open("history_log.json", "w", encoding='utf-8') as f:
-                    json.dump(self.history, f, indent=2, ensure_ascii=False)
-            except Exception:
-                pass
+            print("[System] Amnesia: Pruned an old image from history")
 
-    def _prune_active_cooking_images(self):
+    def _prune_history_images(self, entry):
         """
-        Amnesia Strategy: Keeps only the latest 3 images from the ACTIVE_COOKING state.
-        Removes the 'image_url' field from older messages to save tokens.
+        Amnesia Strategy: Images dominate the request size, so only a few are kept.
+        - ACTIVE_COOKING: the latest 3 images (visual memory of the progress).
+        - Other states: an image is only kept while it is the most recent one.
+        Called with each new user entry; the kept images are tracked as they are
+        appended, so the history is never rescanned.
         """
-        active_cooking_image_indices = []
-
-        # 1. Identify all User messages that have images AND are in ACTIVE_COOKING
-        for i, msg in enumerate(self.history):
-            if msg["role"] == "user" and isinstance(msg["content"], list):
-                # Check if this message has an image
-                has_image = any(item.get("type") == "image_url" for item in msg["content"])
-                
-                if has_image:
-                    # Check if the state context was ACTIVE_COOKING
-                    try:
-                        # Extract the text part which contains the JSON context
-                        text_part = next(item for item in msg["content"] if item.get("type") == "text")
-                        context = json.loads(text_part["text"])
-                        
-                        if context.get("current_state") == "ACTIVE_COOKING":
-                            active_cooking_image_indices.append(i)
-                    except (StopIteration, json.JSONDecodeError, KeyError):
-                        continue
+        if not isinstance(entry["content"], list) or not any(item.get("type") == "image_url" for item in entry["content"]):
+            return
 
-        # 2. Prune if count > 3 (Keep the last 3)
-        if len(active_cooking_image_indices) > 3:
-            # Indices to prune: All except the last 3
-            indices_to_prune = active_cooking_image_indices[:-3]
-            
-            for idx in indices_to_prune:
-                # Rebuild content list EXCLUDING the image_url item
-                original_content = self.history[idx]["content"]
-                new_content = [item for item in original_content if item.get("type") != "image_url"]
-                
-                # Add a placeholder so the AI knows an image used to be there
-                new_content.append({
-                    "type": "text", 
-                    "text": "[System Note: Older image data stripped to save memory]"
-                })
-                
-                self.history[idx]["content"] = new_content
-                if self.debug:
-                    print(f"[System] Amnesia: Pruned old image at history index {idx}")
+        # A setup-state image stops being the most recent one
+        if self._latest_other_image is not None:
+            self._strip_image(self._latest_other_image)
+            self._latest_other_image = None
+
+        if self.current_state_name == "ACTIVE_COOKING":
+            self._cooking_images.append(entry)
+            while len(self._cooking_images) > 3:
+                self._strip_image(self._cooking_images.popleft())
+        else:
+            self._latest_other_image = entry
 
     def update_history(self, role, content):
         """
         Smart History Management.
         """
+        content_json = None
         if role == "assistant":
             try:
-                content_json = json.loads(content)
+                content_json = json_loads(content)
                 status = content_json.get("status", "")
                 speech = content_json.get("speech_output", "")
 
@@ -172,259 +548,628 @@ class CookingAssistant:
                     prev_assistant_msg = self.history[-2] 
                     if prev_assistant_msg["role"] == "assistant":
                         try:
-                            prev_json = json.loads(prev_assistant_msg["content"])
+                            # Reuse the parse from the previous turn instead of decoding it again
+                            if self._last_reply and self._last_reply[0] is prev_assistant_msg:
+                                prev_json = self._last_reply[1]
+                            else:
+                                prev_json = json_loads(prev_assistant_msg["content"])
                             prev_status = prev_json.get("status", "")
                             
-                            if prev_status == "MONITORING_NO_CHANGE" or "MONITORING_NO_CHANGE *" in prev_json.get("debug_note", ""):
+                            if prev_status == "MONITORING_NO_CHANGE" or prev_json.get("debug_note", "").startswith("MONITORING_NO_CHANGE *"):
                                 count = prev_json.get("monitor_count", 1) + 1
                                 content_json["monitor_count"] = count
                                 content_json["debug_note"] = f"MONITORING_NO_CHANGE * {count}"
                                 
-                                content = json.dumps(content_json)
+                                content = json_text(content_json)
                                 print(f"[System] Merging Monitor Log. Count: {count}")
                                 
-                                if len(self.history) >= 3:
-                                    del self.history[-3]
-                                    del self.history[-2]
+                                with self._history_lock:
+                                    if len(self.history) >= 3:
+                                        # The merged-away frame no longer counts towards the kept images
+                                        merged = self.history[-3]
+                                        self._cooking_images = deque(e for e in self._cooking_images if e is not merged)
+                                        self._frame_turns.pop(id(merged), None)
+                                        del self.history[-3]
+                                        del self.history[-2]
                         except json.JSONDecodeError:
                             pass
             except json.JSONDecodeError:
                 pass
 
-        self.history.append({"role": role, "content": content})
-        
+        entry = {"role": role, "content": content}
+        with self._history_lock:
+            self.history.append(entry)
+        if role == "assistant":
+            self._last_reply = (entry, content_json) if content_json is not None else None
+
         # --- NEW: Trigger Amnesia Strategy ---
         if role == "user":
-            self._prune_active_cooking_images()
-            
-        self._save_history()
+            self._turn_count += 1
+            with self._history_lock:  # The summarizer may be trimming the image index
+                if isinstance(content, list) and any(item.get("type") == "image_url" for item in content):
+                    self._frame_turns[id(entry)] = (entry, self._turn_count)
+                self._prune_history_images(entry)
 
-    def call_gpt_api(self, user_voice, image_base64=None):
-        current_state_obj = self.states[self.current_state_name]
+        # --- Rolling Memory: fold old turns into the summary (in background) ---
+        if role == "assistant" and len(self.history) > 2 * SUMMARY_TRIGGER_TURNS and not self._summarizing:
+            self._summarizing = True
+            self._executor.submit(self._summarize_old_turns)
 
-        # --- SYSTEM PROMPT ---
-        system_prompt = """
-        You are a Smart Cooking Assistant.
+        self._save_history(entry)
 
-        ### LANGUAGE PROTOCOL ###
-        - CRITICAL: All content in "speech_output" MUST be in Traditional Chinese (Taiwan/繁體中文).
-        - Internal JSON values (status, next_state, timer_name, thought_process) MUST remain in English.
-        
-        OUTPUT JSON FORMAT:
-        {
-            "thought_process": "1. Analyze image (describe strictly what you see). 2. Compare to goal. 3. Formulate response.",
-            "speech_output": "Text to speak (empty string if strictly monitoring with no update)",
-            "status": "MONITORING_NO_CHANGE" | "INSTRUCTION_UPDATE" | "USER_INTERACTION",
-            "next_state": "Exact string name of the next state",
-            "timer_name": "Name (e.g. 'Pasta') or null",
-            "timer_duration": "Seconds (int) or null"
-        }
+    def _summarize_old_turns(self):
+        """
+        Replaces everything before the recent window with a short summary
+        produced by SUMMARY_MODEL. Runs on the executor; the history lock keeps
+        the cut consistent with turns appended meanwhile.
+        """
+        try:
+            with self._history_lock:
+                # Cut on a user message so the recent window starts with a full turn
+                cut = len(self.history) - 2 * MAX_RECENT_TURNS
+                while cut > 0 and self.history[cut]["role"] != "user":
+                    cut -= 1
+                old_turns = self.history[:cut]
+            if not old_turns:
+                return
 
-        ### STATE TRANSITION ENFORCEMENT (HIGHEST PRIORITY) ###
-        1. You are a State Machine. You are currently in: '{current_state}'.
-        2. You MUST select 'next_state' ONLY from this list: {valid_next_states}.
-        3. DO NOT invent new states. DO NOT switch state if the user did not agree.
+            transcript = []
+            if self.summary:
+                transcript.append(f"Previous summary: {self.summary}")
+            for msg in old_turns:
+                content = msg["content"]
+                if isinstance(content, list):
+                    # Images are not worth summarizing, keep the text context only
+                    content = " ".join(item["text"] for item in content if item.get("type") == "text")
+                transcript.append(f"{msg['role']}: {content}")
 
-        ### VISUAL REASONING PROTOCOL (Use 'thought_process' for this) ###
-        When asked to judge the state of food (e.g., cut size, doneness):
-        1. FIRST, describe strictly what you see in the image (e.g., "I see a whole fillet," or "I see large chunks").
-        2. THEN, compare it to the goal state.
-        3. ONLY THEN give your verdict in 'speech_output'.
+            payload = {
+                "model": SUMMARY_MODEL,
+                "messages": [
+                    {"role": "system", "content": SUMMARY_PROMPT},
+                    {"role": "user", "content": "\n".join(transcript)}
+                ],
+                "max_tokens": 200
+            }
+            response = self.session.post(CHAT_COMPLETIONS_URL, data=json_bytes(payload), timeout=REQUEST_TIMEOUT)
+            data = response.json()
+            if "error" in data: return
 
-        INSTRUCTIONS:
-        
-        1. SETUP PHASE (States: START -> INGREDIENT_SCAN -> RECIPE_CONFIRMATION -> INSTRUCTION_OVERVIEW):
-           - State: START
-             * Goal: Greet and ask to see ingredients.
-             * ACTION: If user says "Hi", "Ready" or agrees, MUST output "next_state": "INGREDIENT_SCAN" immediately. Do NOT wait for image here.
-           - State: INGREDIENT_SCAN
-             * Goal: Analyze image, identify ingredients, propose dish.
-           - State: RECIPE_CONFIRMATION
-             * Goal: Wait for agreement. Move to INSTRUCTION_OVERVIEW.
-           - State: INSTRUCTION_OVERVIEW
-             * Goal: List steps. Ask "Ready to cook?". Move to ACTIVE_COOKING.
+            summary = data['choices'][0]['message']['content'].strip()
+            with self._history_lock:
+                # Only drop the turns we actually summarized (still the same entries)
+                if len(self.history) >= len(old_turns) and all(a is b for a, b in zip(self.history, old_turns)):
+                    del self.history[:len(old_turns)]
+                    dropped = {id(msg) for msg in old_turns}
+                    self._cooking_images = deque(e for e in self._cooking_images if id(e) not in dropped)
+                    for key in dropped:
+                        self._frame_turns.pop(key, None)
+                    self.summary = summary
+                    # A server-side chain still holds the full context; start a new one
+                    self.last_response_id = None
+            if self.debug:
+                print(f"[System] Memory: Summarized {len(old_turns)} old messages.")
 
-        2. ACTIVE COOKING PHASE (State: ACTIVE_COOKING):
-           
-           ### SUB-CATEGORY 1: IF 'user_voice' IS EMPTY (Visual Monitoring Mode)
-           1. CASE (General Monitoring): 
-              CRITICAL: You are a PASSIVE OBSERVER. Do NOT check in. Do NOT ask if they are done.
-              Even if the step looks finished visually, keep waiting.
-              Output status "MONITORING_NO_CHANGE" and empty speech_output.
-           2. CASE (Visual Mistake / Safety Hazard): 
-              ONLY speak if the user is making a specific error (e.g., burning food, cutting dangerously).
-              Explain the error clearly.
+        except Exception as e:
+            print(f"[System] Summary Error: {e}")
+        finally:
+            self._summarizing = False
 
-           ### SUB-CATEGORY 2: IF 'user_voice' IS NOT EMPTY (Interaction Mode)
-           1. CASE (User says "Ok", "Got it", "Sure", "I see"):
-              This is ACKNOWLEDGMENT. Do NOT move to the next step. 
-              Output: "speech_output": "" (or very brief confirmation), "status": "MONITORING_NO_CHANGE".
-           2. CASE (User explicitly confirms COMPLETION or asks for NEXT):
-              (e.g., "I'm done", "Next step", "What's next?", "Ready").
-              ACTION: Explain the NEXT step. Set status="INSTRUCTION_UPDATE".
-           3. CASE (User asks visual judgment question): 
-              (e.g. "Is it small enough?", "Is this done?").
-              ACTION: Check 'thought_process' logic.
-              - If the food looks exactly the same as the raw ingredient: Say "It doesn't look diced yet. It looks like a whole piece."
-              - If you can't see it clearly: Say "I can't see the salmon clearly. Can you bring it closer?"
-              - Only say "Yes" if you clearly see distinct small pieces.
-           4. CASE (User asks general question):
-              Answer the question. Remain on current step.
+    def _history_snapshot(self):
+        """Copy of the history list and the index of its newest user message."""
+        with self._history_lock:
+            history = list(self.history)
+        newest_user = next((i for i in range(len(history) - 1, -1, -1) if history[i]["role"] == "user"), None)
+        return history, newest_user
 
-        3. GENERAL RULES:
-           - "timer_name/duration": If user starts a timed task, provide details. Confirm verbally.
+    def _payload_message(self, i, msg, newest_user):
         """
+        History entry i as sent to the API. Frames of earlier turns are replaced
+        by a short note in a copy, so each call carries a single image. The note
+        names the turn counted when the entry was added, so it does not change
+        when a summary or a merge shifts the list.
+        """
+        content = msg["content"]
+        if self.visual_memory or i == newest_user or not isinstance(content, list):
+            return msg
+        if not any(item.get("type") == "image_url" for item in content):
+            return msg
+        known = self._frame_turns.get(id(msg))
+        turn = known[1] if known and known[0] is msg else "?"
+        return {"role": msg["role"], "content": [
+            item if item.get("type") != "image_url" else {"type": "text", "text": f"[frame from turn {turn} omitted]"}
+            for item in content
+        ]}
 
-        turn_context = {
-            "current_state": current_state_obj.name,
-            "goal": current_state_obj.description,
-            "valid_next_states": current_state_obj.valid_next_states,
-            "timestamp": datetime.now().isoformat(),
-            "user_voice": user_voice,
-            "image_provided": image_base64 is not None
-        }
+    def _payload_history(self):
+        history, newest_user = self._history_snapshot()
+        return [self._payload_message(i, msg, newest_user) for i, msg in enumerate(history)]
+
+    def _payload_history_bytes(self):
+        """
+        The payload history as comma-separated JSON. Each entry is serialized once
+        and reused until it changes (pruned, merged away, or no longer the newest frame).
+        """
+        history, newest_user = self._history_snapshot()
+        serialized = {}
+        parts = []
+        for i, msg in enumerate(history):
+            layout = i == newest_user  # Only decides whether the frame is kept
+            cached = self._history_json.get(id(msg))
+            if cached and cached[0] is msg and cached[1] is msg["content"] and cached[2] == layout:
+                data = cached[3]
+            else:
+                data = json_bytes(self._payload_message(i, msg, newest_user))
+            serialized[id(msg)] = (msg, msg["content"], layout, data)
+            parts.append(data)
+        self._history_json = serialized
+        return b",".join(parts)
+
+    def _summary_messages(self):
+        """The running summary as a single system message (empty if none yet)."""
+        if not self.summary:
+            return []
+        return [{"role": "system", "content": f"PRIOR_SESSION_SUMMARY:\n{self.summary}"}]
+
+    def _build_user_message(self, user_voice, image_base64=None):
+        current_state_obj = self.states[self.current_state_name]
 
-        user_message = [{"type": "text", "text": json.dumps(turn_context)}]
+        # Same JSON as dumping the full turn context dict, without rebuilding the static part
+        turn_context = (
+            current_state_obj._prompt_head
+            + f'"timestamp": "{datetime.now().isoformat()}", '
+            + f'"user_voice": {json_text(user_voice)}, '
+            + f'"image_provided": {"true" if image_base64 is not None else "false"}}}'
+        )
+
+        user_message = [{"type": "text", "text": turn_context}]
         if image_base64:
             user_message.append({
                 "type": "image_url",
-                "image_url": {"url": f"data:image/jpeg;base64,{image_base64}"}
+                "image_url": {
+                    "url": self._image_url(image_base64),
+                    # Silent monitoring only needs the cheap low-res pass;
+                    # keep full detail when the user asks about what they show.
+                    "detail": "auto" if user_voice else "low"
+                }
             })
 
+        return user_message
+
+    def _image_url(self, image_base64):
+        """
+        The data: URL of a frame. Cameras return the very same string for an
+        unchanged scene, so the (large) URL is only built once per new frame.
+        """
+        if self._last_image_url[0] is not image_base64:
+            self._last_image_url = (image_base64, IMAGE_URL_PREFIX + image_base64)
+        return self._last_image_url[1]
+
+    def _cache_key(self, user_voice, image_base64=None):
+        """
+        Identical input in the same spot of the conversation gets the same reply.
+        The previous assistant reply is part of the key so "What's next?" is
+        never answered from a different step.
+        """
+        frame_hash = self._frame_hash(image_base64) if image_base64 else None
+        last_reply = next((msg["content"] for msg in reversed(self.history) if msg["role"] == "assistant"), "")
+        return (
+            self.current_state_name,
+            user_voice.lower().strip(),
+            frame_hash,
+            hashlib.blake2b(last_reply.encode("utf-8"), digest_size=8).digest()
+        )
+
+    def call_gpt_api(self, user_voice, image_base64=None):
+        user_message = self._build_user_message(user_voice, image_base64)
+        # The server-side chain would miss cached turns, so only cache stateless calls
+        cache_key = None if self.stateful else self._cache_key(user_voice, image_base64)
+
         self.update_history("user", user_message)
 
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.api_key}"
-        }
-        
-        payload = {
-            "model": "gpt-4o",
-            "messages": [{"role": "system", "content": system_prompt}] + self.history,
-            "response_format": {"type": "json_object"},
-            "max_tokens": 500  # Increased to accommodate thought process
-        }
+        cached = self._response_cache.get(cache_key)
+        if cached is not None:
+            self._response_cache.move_to_end(cache_key)
+            print("[System] Cache hit, skipped API call.")
+            self.update_history("assistant", cached)
+            return dict(self._last_reply[1])
+
+        max_tokens = self.max_tokens
+        if user_voice or self.current_state_name in LONG_REPLY_STATES:
+            max_tokens = self.long_max_tokens
 
         try:
-            response = requests.post("https://api.openai.com/v1/chat/completions", headers=headers, json=payload)
-            data = response.json()
-            if "error" in data: return None
-            
-            assistant_content = data['choices'][0]['message']['content']
+            if self.current_state_name == "ACTIVE_COOKING" and not user_voice:
+                # Not streamed: if the cheap model is escalated, its speech must not be heard
+                chain_id = self.last_response_id
+                assistant_content, streamed = self._request_whole(user_message, MONITOR_MODEL, False, max_tokens)
+
+                if assistant_content is not None and not self._is_no_change(assistant_content):
+                    print("[System] Monitor model saw something, escalating to main model.")
+                    self.last_response_id = chain_id  # Drop the cheap reply from the chain
+                    assistant_content, streamed = self._request_whole(user_message, MAIN_MODEL, self.stream, max_tokens)
+            else:
+                assistant_content, streamed = self._request_whole(user_message, MAIN_MODEL, self.stream, max_tokens)
+            if assistant_content is None: return None
+
             self.update_history("assistant", assistant_content)
-            return json.loads(assistant_content)
+            if self._last_reply is None:
+                raise ValueError("Reply is not valid JSON")
+            response = dict(self._last_reply[1])  # Copy: the parsed reply also backs the history cache
+
+            if cache_key is not None:
+                self._response_cache[cache_key] = assistant_content
+                if len(self._response_cache) > RESPONSE_CACHE_SIZE:
+                    self._response_cache.popitem(last=False)
+
+            if streamed:
+                response["_speech_streamed"] = True
+            return response
 
         except Exception as e:
             print(f"Network/Parsing Error: {e}")
             return None
 
+    def _request_whole(self, user_message, model, stream, max_tokens):
+        """
+        _request, retried once with twice the room if the reply was cut off, so a
+        broken reply never reaches the history. Returns (text, whether it was streamed).
+        """
+        try:
+            return self._request(user_message, model, stream, max_tokens), stream
+        except ReplyTruncated:
+            print("[System] Reply hit the token limit, retrying with more room.")
+            if stream:
+                self.speaker.interrupt()  # The cut-off speech is said again in full
+            return self._request(user_message, model, False, 2 * max_tokens), False
+
+    def _is_no_change(self, assistant_content):
+        try:
+            return json_loads(assistant_content).get("status") == "MONITORING_NO_CHANGE"
+        except (json.JSONDecodeError, AttributeError):
+            return False
+
+    def _request(self, user_message, model, stream, max_tokens):
+        """
+        Returns the assistant's raw reply text (None on API error).
+        Raises ReplyTruncated if the reply ran into max_tokens.
+        """
+        if self.stateful:
+            return self._request_stateful(user_message, model, stream, max_tokens)
+        return self._request_chat(model, stream, max_tokens)
+
+    def _request_chat(self, model, stream, max_tokens):
+        """Stateless Chat Completions call: replays the full local history."""
+        payload = {
+            "model": model,
+            "response_format": {"type": "json_object"},
+            "max_tokens": max_tokens,
+            "stream": stream
+        }
+
+        # Only the new history entries are encoded; the rest is spliced in as bytes
+        messages = [self._system_msg_bytes] + [json_bytes(msg) for msg in self._summary_messages()]
+        history = self._payload_history_bytes()
+        if history:
+            messages.append(history)
+        body = b"".join([json_bytes(payload)[:-1], b',"messages":[', b",".join(messages), b"]}"])
+
+        with self.session.post(CHAT_COMPLETIONS_URL, data=body, stream=stream, timeout=REQUEST_TIMEOUT) as response:
+            if response.status_code != 200: return None
+
+            if stream:
+                streamer = SpeechStreamer(self.speaker.play_text)
+                for event in self._iter_sse(response):
+                    choices = event.get("choices")
+                    if choices:
+                        streamer.feed(choices[0]["delta"].get("content") or "")
+                        if choices[0].get("finish_reason") == "length":
+                            raise ReplyTruncated()
+                return streamer.finish()
+
+            data = json_loads(response.content)
+            if data['choices'][0].get('finish_reason') == "length":
+                raise ReplyTruncated()
+            return data['choices'][0]['message']['content']
+
+    def _iter_sse(self, response):
+        """Yields the JSON events of a server-sent events stream."""
+        for line in response.iter_lines():
+            if not line or not line.startswith(b"data: "):
+                continue
+            data = line[len(b"data: "):]
+            if data == b"[DONE]":
+                return
+            yield json_loads(data)
+
+    def _to_responses_input(self, messages):
+        """Converts Chat Completions style messages into Responses API input items."""
+        items = []
+        for msg in messages:
+            content = msg["content"]
+            if isinstance(content, list):
+                parts = []
+                for item in content:
+                    if item.get("type") == "image_url":
+                        parts.append({
+                            "type": "input_image",
+                            "image_url": item["image_url"]["url"],
+                            "detail": item["image_url"].get("detail", "auto")
+                        })
+                    else:
+                        parts.append({"type": "input_text", "text": item["text"]})
+                content = parts
+            items.append({"role": msg["role"], "content": content})
+        return items
+
+    def _request_stateful(self, user_message, model, stream, max_tokens):
+        """
+        Responses API call chained with previous_response_id.
+        Only the new user message is uploaded; if the server no longer knows
+        the previous response (expired / not found), replay the history once.
+        """
+        for attempt in range(2):
+            payload = {
+                "model": model,
+                "instructions": self._system_msg["content"],  # Not inherited through previous_response_id
+                "text": {"format": {"type": "json_object"}},
+                "max_output_tokens": max_tokens,
+                "stream": stream
+            }
+            if self.last_response_id:
+                payload["previous_response_id"] = self.last_response_id
+                payload["input"] = self._to_responses_input([{"role": "user", "content": user_message}])
+            else:
+                payload["input"] = self._to_responses_input(self._summary_messages() + self._payload_history())
+
+            with self.session.post(RESPONSES_URL, data=json_bytes(payload), stream=stream, timeout=REQUEST_TIMEOUT) as response:
+                if response.status_code != 200:
+                    try:
+                        error = json_loads(response.content).get("error") or {}
+                    except (json.JSONDecodeError, AttributeError):
+                        error = {}  # Proxy / gateway error pages are not JSON
+                    # Only a lost chain is fixed by replaying; a rate limit or a bad
+                    # request would just turn into the largest possible request
+                    chain_lost = response.status_code == 404 or error.get("code") == "previous_response_not_found"
+                    if self.last_response_id and attempt == 0 and chain_lost:
+                        print(f"[System] Response chain lost ({error.get('code')}). Replaying history.")
+                        self.last_response_id = None
+                        continue
+                    print(f"[System] API error {response.status_code}: {error.get('message', '')}")
+                    return None
+
+                if stream:
+                    streamer = SpeechStreamer(self.speaker.play_text)
+                    for event in self._iter_sse(response):
+                        if event.get("type") == "response.output_text.delta":
+                            streamer.feed(event["delta"])
+                        elif event.get("type") == "response.completed":
+                            self.last_response_id = event["response"]["id"]
+                        elif event.get("type") == "response.incomplete":
+                            raise ReplyTruncated()  # The chain keeps pointing at the last complete reply
+                    return streamer.finish()
+
+                data = json_loads(response.content)
+                if data.get("status") == "incomplete":
+                    raise ReplyTruncated()
+                self.last_response_id = data["id"]
+                for item in data.get("output", []):
+                    if item.get("type") != "message":
+                        continue
+                    for part in item.get("content", []):
+                        if part.get("type") == "output_text":
+                            return part["text"]
+                return None
+
+    def _frame_thumbnail(self, image_base64):
+        """64x64 grayscale thumbnail used for cheap change detection."""
+        if cv2 is None:
+            return image_base64
+        # The change check and the cache key look at the same frame: decode it once
+        if self._last_thumbnail[0] is image_base64:
+            return self._last_thumbnail[1]
+        buffer = np.frombuffer(base64.b64decode(image_base64), dtype=np.uint8)
+        frame = cv2.imdecode(buffer, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+        thumbnail = cv2.resize(frame, (64, 64), interpolation=cv2.INTER_AREA)
+        self._last_thumbnail = (image_base64, thumbnail)
+        return thumbnail
+
+    def _frame_hash(self, image_base64):
+        """64-bit average hash: small camera noise maps to the same key."""
+        if cv2 is None:
+            return hashlib.blake2b(image_base64.encode("ascii"), digest_size=8).digest()
+        small = cv2.resize(self._frame_thumbnail(image_base64), (8, 8), interpolation=cv2.INTER_AREA)
+        return np.packbits(small > small.mean()).tobytes()
+
+    def _scene_changed(self, thumbnail):
+        if self.last_frame_small is None:
+            return True
+        if cv2 is None:
+            return thumbnail != self.last_frame_small
+        return cv2.absdiff(thumbnail, self.last_frame_small).mean() >= FRAME_DIFF_THRESHOLD
+
+    def _record_local_no_change(self, image_base64):
+        """Logs a monitoring tick as if GPT answered MONITORING_NO_CHANGE (keeps the merge counter going)."""
+        self.update_history("user", self._build_user_message("", image_base64))
+        self.update_history("assistant", self._local_no_change_reply)
+        print("✅ Monitoring... (Scene unchanged, skipped API call)")
+
     def check_timers(self):
-        """Checks if any local timers have expired."""
+        """
+        Checks if any local timers have expired.
+        Timers about to end within TIMER_BATCH_WINDOW are reported with them,
+        so close expirations cost one API call instead of several.
+        """
         now = time.time()
         expired = []
-        for i in range(len(self.active_timers) - 1, -1, -1):
-            timer = self.active_timers[i]
-            if now >= timer['end_time']:
-                expired.append(timer['name'])
-                del self.active_timers[i]
-        
+        # Earliest timer is always on top: nothing to scan while it is still running
+        if self.active_timers and self.active_timers[0][0] <= now:
+            while self.active_timers and self.active_timers[0][0] <= now + TIMER_BATCH_WINDOW:
+                expired.append(heapq.heappop(self.active_timers)[1])
+
         if expired:
-            return f"[System Notification: The following timers have finished: {', '.join(expired)}. Please inform the user.]"
+            notification = f"[System Notification: The following timers have finished: {', '.join(expired)}. Please inform the user.]"
+            # Fold in anything the user already said so one call answers both
+            pending_voice = self.mic.read_text()
+            if pending_voice:
+                print(f"👤 User: {pending_voice}")
+                notification += f"\nUser said: {pending_voice}"
+            return notification
         return None
 
-    def run(self):
-        self.speak("系統啟動中 (System starting)")
+    def _time_to_next_timer(self):
+        """Seconds until the earliest timer ends (inf if none). The heap top, so O(1)."""
+        if not self.active_timers:
+            return float("inf")
+        return self.active_timers[0][0] - time.time()
+
+    # --- STATE HANDLERS ---
+    # Each handler runs one tick of its state and returns the next state name.
+
+    def _handle_start(self):
+        """Waits for the user to answer the greeting, then moves on without an API call."""
+        print("🎤 Waiting for audio...")
+        user_voice = ""
+        while not user_voice:
+            user_voice = self.listen(timeout=5, quiet_timeout=0.3)
+
+        # Logged like a normal turn so the model sees how the session started
+        self.update_history("user", self._build_user_message(user_voice))
+        self.update_history("assistant", json_text(START_RESPONSE))
+        self.speak(START_RESPONSE["speech_output"])
+        return START_RESPONSE["next_state"]
+
+    def _handle_reactive(self):
+        """Setup states: wait for the user (or a timer), then answer."""
+        state_obj = self.states[self.current_state_name]
+        user_voice = ""
+        image_data = None
+        timer_notification = None
+
+        print("🎤 Waiting for audio...")
 
         while True:
-            state_obj = self.states[self.current_state_name]
-            print(f"\n--- State: {state_obj.name} ---")
+            # Priority 1: Check Timers
+            timer_notification = self.check_timers()
+            if timer_notification:
+                print(f"⏰ {timer_notification}")
+                user_voice = timer_notification
+                break 
             
-            user_voice = ""
-            image_data = None
-            timer_notification = None
-
-            # --- LOGIC SPLIT: ACTIVE vs OTHERS ---
-
-            if self.current_state_name == "ACTIVE_COOKING":
-                # === PROACTIVE MODE ===
-                # 1. Check Timers
-                timer_notification = self.check_timers()
-                if timer_notification:
-                    print(f"⏰ {timer_notification}")
-                    user_voice = timer_notification
-                
-                # 2. Listen (Wait up to 5s for voice)
-                if not user_voice:
-                    user_voice = self.listen(timeout=5)
-
-                # 3. Capture Image (Fresh!)
-                if state_obj.requires_image and not timer_notification:
-                    print("📸 Monitoring Capture...")
-                    image_data = self.capture_image()
+            # Priority 2: Check Voice (returns quickly on silence so timers are checked promptly)
+            voice_input = self.listen(timeout=5, quiet_timeout=0.3)
+            if voice_input:
+                user_voice = voice_input
+                break 
+        
+        if state_obj.requires_image and not timer_notification:
+            print("📸 Reactive Capture...")
+            image_data = self.capture_image()  # Shows what the user just asked about
+
+        return self._respond(user_voice, image_data)
 
+    def _handle_active_cooking(self):
+        """Proactive mode: timers, a 5 s listen window and a fresh frame every tick."""
+        state_obj = self.states[self.current_state_name]
+        user_voice = ""
+        image_data = None
+
+        # 1. Check Timers
+        timer_notification = self.check_timers()
+        if timer_notification:
+            print(f"⏰ {timer_notification}")
+            user_voice = timer_notification
+        
+        # 2. Listen (Wait up to 5s for voice, less if a timer is due sooner)
+        if not user_voice:
+            user_voice = self.listen(timeout=min(5, self._time_to_next_timer()))
+            # A timer came due mid-window: skip the frame and announce it right away
+            if not user_voice and self._time_to_next_timer() <= 0:
+                return "ACTIVE_COOKING"
+
+        # 3. Capture Image (Fresh!) once the window is over, also covering whatever
+        # the user may be showing while asking. The camera's reader thread already
+        # holds the latest frame, so this is only the encode.
+        if state_obj.requires_image and not timer_notification:
+            print("📸 Monitoring Capture...")
+            image_data = self.capture_image()
+
+        # 4. Local short-circuit: silent and nothing moved
+        if user_voice:
+            # The reply may start a new step, so the next silent frame goes to the model
+            self.last_frame_small = None
+        elif image_data:
+            thumbnail = self._frame_thumbnail(image_data)
+            if not self._scene_changed(thumbnail):
+                self._record_local_no_change(image_data)
+                return "ACTIVE_COOKING"
+            self.last_frame_small = thumbnail
+
+        return self._respond(user_voice, image_data)
+
+    def _respond(self, user_voice, image_data):
+        """Calls the API, acts on the reply and returns the next state name."""
+        response = self.call_gpt_api(user_voice, image_data)
+        if not response:
+            return self.current_state_name
+
+        thought = response.get("thought_process", "")
+        speech = response.get("speech_output", "")
+        status = response.get("status", "")
+        next_state = response.get("next_state")
+        timer_name = response.get("timer_name")
+        timer_duration = response.get("timer_duration")
+
+        # Debug: Print Thought Process to Console
+        if thought:
+            print(f"💭 Thought: {thought}")
+
+        if timer_name and timer_duration:
+            try:
+                duration_sec = int(timer_duration)
+                heapq.heappush(self.active_timers, (time.time() + duration_sec, timer_name))
+                print(f"⏳ Timer Started: {timer_name} ({duration_sec}s)")
+            except ValueError: pass
+
+        if speech:
+            if response.get("_speech_streamed"):
+                print(f"🤖 AI: {speech}")  # Already queued sentence by sentence
             else:
-                # === REACTIVE MODE (Wait for Input) ===
-                print("🎤 Waiting for audio...")
-                
-                while True:
-                    # Priority 1: Check Timers
-                    timer_notification = self.check_timers()
-                    if timer_notification:
-                        print(f"⏰ {timer_notification}")
-                        user_voice = timer_notification
-                        break 
-                    
-                    # Priority 2: Check Voice
-                    voice_input = self.listen(timeout=5)
-                    if voice_input:
-                        user_voice = voice_input
-                        break 
-                
-                if state_obj.requires_image and not timer_notification:
-                    print("📸 Reactive Capture...")
-                    image_data = self.capture_image()
-
-            # --- CALL API ---
-            if not user_voice and not image_data and self.current_state_name == "START":
-                continue 
-
-            response = self.call_gpt_api(user_voice, image_data)
-            if not response: continue
-
-            # --- PROCESS RESPONSE ---
-            thought = response.get("thought_process", "")
-            speech = response.get("speech_output", "")
-            status = response.get("status", "")
-            next_state = response.get("next_state")
-            timer_name = response.get("timer_name")
-            timer_duration = response.get("timer_duration")
-
-            # Debug: Print Thought Process to Console
-            if thought:
-                print(f"💭 Thought: {thought}")
-
-            if timer_name and timer_duration:
-                try:
-                    duration_sec = int(timer_duration)
-                    self.active_timers.append({"name": timer_name, "end_time": time.time() + duration_sec})
-                    print(f"⏳ Timer Started: {timer_name} ({duration_sec}s)")
-                except ValueError: pass
-
-            if speech:
                 self.speak(speech)
-            elif status == "MONITORING_NO_CHANGE":
-                print("✅ Monitoring... (No instructions needed)")
+        elif status == "MONITORING_NO_CHANGE":
+            print("✅ Monitoring... (No instructions needed)")
 
-            if next_state in self.states:
-                self.current_state_name = next_state
-            elif next_state == "FINISHED":
-                print("Cooking Session Complete.")
-                break
+        if next_state in self.states:
+            return next_state
+        return self.current_state_name
 
+    def run(self):
+        self.speak("系統啟動中 (System starting)")
+
+        while self.current_state_name != "FINISHED":
+            print(f"\n--- State: {self.current_state_name} ---")
+            self.current_state_name = self.states[self.current_state_name].handler()
+
+        print("Cooking Session Complete.")
+
+        # Let the last sentences finish before shutting down
+        self.speaker.wait_idle()
         self.camera.release()
+        self._close_history_log()
+
+def print_history_log(path):
+    """Pretty-prints a history snapshot (plain or .zst) for debugging."""
+    with open(path, "rb") as f:
+        data = f.read()
+    if path.endswith(".zst"):
+        data = zstandard.ZstdDecompressor().decompress(data)
+    print(json.dumps(json_loads(data), indent=2, ensure_ascii=False))
 
 if __name__ == "__main__":
-    if not API_KEY:
+    if len(sys.argv) == 3 and sys.argv[1] == "--pretty":
+        # python assistance.py --pretty history_log.json.zst
+        print_history_log(sys.argv[2])
+    elif not API_KEY:
         print("Please set OPENAI_API_KEY environment variable.")
     else:
         bot = CookingAssistant(debug=True)
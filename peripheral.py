@@ -1,29 +1,91 @@
 import threading
 import queue
+from collections import deque
 import pyttsx3
-import base64, time
+import time
+try:
+    import pybase64 as base64  # SIMD-accelerated, same API as the stdlib module
+except ImportError:
+    import base64
 import speech_recognition as sr
 import os
 import sys
+import json
 from contextlib import contextmanager
-import re, tempfile, subprocess
+import re, subprocess, hashlib
+
+try:
+    import cv2
+    import numpy as np
+except ImportError:
+    cv2 = None  # Frames are then uploaded as captured
+
+# Frames are uploaded on every monitoring tick: 768 px is GPT-4o's vision
+# tile size, anything larger only costs bandwidth and tokens.
+MAX_IMAGE_SIDE = 768
+JPEG_QUALITY = 70
+
+def encode_jpeg(frame):
+    """Downscales a BGR frame to MAX_IMAGE_SIDE and encodes it as JPEG (None on failure)."""
+    h, w = frame.shape[:2]
+    scale = MAX_IMAGE_SIDE / max(h, w)
+    if scale < 1:
+        frame = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+    ok, buffer = cv2.imencode(".jpg", frame, [
+        cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY,
+        cv2.IMWRITE_JPEG_OPTIMIZE, 1,
+    ])
+    return buffer if ok else None
 
 # --- CAMERA CLASS ---
 class MockCamera:
     def __init__(self):
         # Ensure you have a file named 'images.jfif' in the same directory
         self.image_path = "images.jfif"
+        self._cached = (None, None)  # (digest of the file, encoded frame)
+        self._cached_stat = None  # (mtime_ns, size) the cache was built from
+        self._buffer = bytearray()  # Reused by every read, grown only for a larger file
 
     def capture(self) -> str:
         try:
             with open(self.image_path, "rb") as image_file:
-                # Read binary file and encode to base64 string
-                print(f"[Mock Camera] Captured {self.image_path}")
-                return base64.b64encode(image_file.read()).decode('utf-8')
+                st = os.fstat(image_file.fileno())
+                # File untouched since the last capture: not even a read is needed
+                if (st.st_mtime_ns, st.st_size) == self._cached_stat:
+                    print(f"[Mock Camera] Captured {self.image_path}")
+                    return self._cached[1]
+                size = st.st_size
+                if len(self._buffer) < size:
+                    self._buffer = bytearray(size)
+                data = memoryview(self._buffer)[:size]
+                data = data[:image_file.readinto(data)]
         except FileNotFoundError:
             print(f"[Mock Camera] Error: '{self.image_path}' not found. Please place an image file in the directory.")
             return None
 
+        print(f"[Mock Camera] Captured {self.image_path}")
+        # Same picture as last time: skip the decode / re-encode
+        digest = hashlib.blake2b(data, digest_size=16).digest()
+        if digest == self._cached[0]:
+            self._cached_stat = (st.st_mtime_ns, st.st_size)
+            return self._cached[1]
+
+        if cv2 is not None:
+            frame = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+            buffer = encode_jpeg(frame) if frame is not None else None
+            if buffer is not None:
+                data = buffer
+
+        # Read binary file and encode to base64 string
+        encoded = base64.b64encode(data).decode('ascii')
+        self._cached = (digest, encoded)
+        self._cached_stat = (st.st_mtime_ns, st.st_size)
+        return encoded
+
+    def release(self):
+        pass
+
 """
 from picamera2 import Picamera2
 
@@ -59,6 +121,112 @@ class RPiCamera:
             return base64.b64encode(img_bytes).decode("utf-8")
 """
 
+# --- USB / V4L2 CAMERA ---
+# Mean per-pixel difference of 32x32 thumbnails below which a frame counts as
+# the same picture and the previous encoding is returned
+SAME_FRAME_THRESHOLD = 1.0
+
+class WebCamera:
+    def __init__(self, device_index=0):
+        if cv2 is None:
+            raise RuntimeError("opencv-python is required for WebCamera.")
+
+        self.camera = cv2.VideoCapture(device_index)
+        # V4L2 queues ~4 frames by default, which makes every capture seconds old
+        self.camera.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+
+        # Double buffer: the worker decodes into the back slot and swaps it to
+        # the front under the lock, so capture() never waits for the camera.
+        self._frames = [None, None]
+        self._front = None
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._cached = (None, None)  # (thumbnail, encoded frame) of the last capture
+
+        self._thread = threading.Thread(target=self._capture_worker, daemon=True)
+        self._thread.start()
+
+    def _capture_worker(self):
+        """Continuously reads frames so the driver buffer never holds stale ones."""
+        back = 0
+        while not self._stop_event.is_set():
+            # Passing the old Mat back in lets OpenCV reuse its memory
+            ret, frame = self.camera.read(self._frames[back])
+            if not ret:
+                time.sleep(0.01)
+                continue
+
+            self._frames[back] = frame
+            with self._lock:
+                self._front = back
+            back = 1 - back
+
+    def capture(self) -> str:
+        # Hold the lock while encoding so the worker cannot swap into this slot
+        with self._lock:
+            if self._front is None:
+                print("[Camera] Error: No frame received yet.")
+                return None
+            frame = self._frames[self._front]
+
+            # A still scene re-uses the last encoding instead of compressing again
+            thumbnail = cv2.resize(frame, (32, 32), interpolation=cv2.INTER_AREA)
+            last_thumbnail, last_encoded = self._cached
+            if last_thumbnail is not None and cv2.absdiff(thumbnail, last_thumbnail).mean() < SAME_FRAME_THRESHOLD:
+                return last_encoded
+
+            buffer = encode_jpeg(frame)
+
+        if buffer is None:
+            return None
+        encoded = base64.b64encode(buffer).decode('ascii')
+        self._cached = (thumbnail, encoded)
+        return encoded
+
+    def release(self):
+        self._stop_event.set()
+        self._thread.join(timeout=1)
+        self.camera.release()
+
+# --- AUDIO THREAD PRIORITY ---
+# The threads that move audio to and from the sound card only wait on I/O, but a
+# late wake-up under load is an ALSA underrun / overrun. SCHED_FIFO needs
+# CAP_SYS_NICE (e.g. `sudo setcap cap_sys_nice+ep $(readlink -f $(which python3))`);
+# without it the thread's nice value is raised instead, and without that too it
+# keeps the default priority. Linux applies all of this per thread. Processes
+# spawned from a boosted thread would inherit it, so only threads that spawn
+# nothing and do no heavy compute call this.
+AUDIO_RT_PRIORITY = 20
+AUDIO_CPU = 1  # Core the audio threads are pinned to (left alone on single-core machines)
+
+def boost_audio_thread():
+    """Raises the calling thread's scheduling priority and pins it to AUDIO_CPU, as far as permitted."""
+    try:
+        cpus = os.sched_getaffinity(0)
+        if AUDIO_CPU in cpus and len(cpus) > 1:
+            os.sched_setaffinity(0, {AUDIO_CPU})
+    except (AttributeError, OSError):
+        pass
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(AUDIO_RT_PRIORITY))
+        return
+    except (AttributeError, OSError):
+        pass
+    try:
+        os.nice(-5)
+    except OSError:
+        pass
+
+# --- SPEAKER CLASS ---
+# A sentence with its terminator; a trailing fragment without one also counts
+SPEAKER_SENTENCE_RE = re.compile(r"[^。！？!?]+[。！？!?]*")
+# _normalize_for_piper, compiled once instead of on every utterance
+SENTENCE_END_RE = re.compile(r"([。！？])")
+COMMA_RE = re.compile(r"[，、]")
+BLANK_LINES_RE = re.compile(r"\n{2,}")
+FIRST_CHUNK_SILENCE = 0.05  # Sentence silence for the first chunk after a clear
+INT8_LOAD_CHECK = 1.0  # Seconds a Piper on the int8 voice must survive at startup
+
 class Speaker:
     def __init__(
         self,
@@ -72,9 +240,18 @@ class Speaker:
     ):
         self.microphone = microphone
         self._lock = threading.Lock()
-        self._is_playing = False
+        # Set while nothing is queued or playing: waiters block on it instead of polling
+        self._idle_event = threading.Event()
+        self._idle_event.set()
+        self._pending = 0  # Texts queued or being spoken
 
         self.piper_bin = piper_bin
+        # Prefer the int8-quantized voice that install_piper.sh writes next to the fp32 one
+        # (dropped again if Piper cannot run it, see _drop_int8)
+        self._fp32_model_path = model_path
+        int8_path = model_path[:-len(".onnx")] + ".int8.onnx" if model_path.endswith(".onnx") else None
+        if int8_path and os.path.exists(int8_path) and os.path.exists(int8_path + ".json"):
+            model_path = int8_path
         self.model_path = model_path
         self.sentence_silence = sentence_silence
         self.volume = volume
@@ -85,121 +262,366 @@ class Speaker:
         if not os.path.exists(self.model_path):
             print(f"⚠️ Warning: Model not found at {self.model_path}")
 
+        # Raw PCM carries no header: aplay needs the voice's rate from its config
+        self.sample_rate = 22050
+        try:
+            with open(self.model_path + ".json", encoding="utf-8") as f:
+                self.sample_rate = json.load(f)["audio"]["sample_rate"]
+        except (OSError, KeyError, ValueError):
+            pass
+
+        # Persistent Piper -> aplay pipeline: the voice model is loaded once, not per utterance
+        self._piper = self._aplay = None
+        self._pipe_lock = threading.Lock()
+        self._audio_cond = threading.Condition()
+        self._audio_chunks = 0  # Raw PCM chunks received from Piper so far
+        self._last_audio = 0.0  # When Piper last produced audio
+        self._play_until = 0.0  # Estimated end of what aplay has been handed
+        self._discard_audio = False  # Set by interrupt(): the rest of the utterance is dropped
+        self._current_procs = ()  # One-shot Piper/aplay of the utterance playing, if any
+        self._start_pipeline()
+
         self._use_queue = use_queue
-        self._queue = queue.Queue()
+        # Single producer (play_text) and consumer (the worker): deque append/popleft
+        # are atomic, the Event only wakes the worker
+        self._queue = deque()
+        self._has_work = threading.Event()
+        self._first_after_clear = True  # Next chunk starts a reply: keep its lead-out short
         
         # Start the persistent worker thread
         if use_queue:
             self._thread = threading.Thread(target=self._play_worker, daemon=True)
             self._thread.start()
 
-    def _set_playing(self, v: bool):
+    def _begin(self):
+        with self._lock:
+            self._pending += 1
+            self._idle_event.clear()
+
+    def _done(self):
         with self._lock:
-            self._is_playing = v
+            self._pending -= 1
+            if self._pending == 0:
+                self._first_after_clear = True
+                self._idle_event.set()
 
     def is_playing(self):
         """Returns True if audio is playing or if queue is not empty."""
-        with self._lock:
-            return self._is_playing or not self._queue.empty()
+        return not self._idle_event.is_set()
+
+    def wait_idle(self, timeout=None):
+        """Blocks until every queued text has been spoken. False if the timeout ran out first."""
+        return self._idle_event.wait(timeout)
 
     def _normalize_for_piper(self, text: str) -> str:
         """Optimizes punctuation for better TTS flow."""
-        text = re.sub(r"[。！？]", lambda m: m.group(0) + "\n", text)  # Newline after sentence end
-        text = re.sub(r"[，、]", " ", text)  # Pause for commas
-        text = re.sub(r"\n{2,}", "\n", text)  # Remove excessive newlines
+        text = SENTENCE_END_RE.sub(r"\1\n", text)  # Newline after sentence end
+        text = COMMA_RE.sub(" ", text)  # Pause for commas
+        text = BLANK_LINES_RE.sub("\n", text)  # Remove excessive newlines
         return text.strip()
 
-    def _speak_one(self, text: str):
-        """Generates WAV with Piper and plays it via aplay."""
-        text = self._normalize_for_piper(text)
+    def _piper_cmd(self, sentence_silence=None):
+        if sentence_silence is None:
+            sentence_silence = self.sentence_silence
+        return [
+            self.piper_bin,
+            "-m", self.model_path,
+            "--output-raw",
+            "--sentence-silence", str(sentence_silence),
+            "--volume", str(self.volume),
+            "--noise-scale", "0.6",
+            "--noise-w-scale", "0.6",
+        ]
 
-        # Create a temp file for the audio
-        with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as f:
-            wav_path = f.name
+    def _aplay_cmd(self):
+        return ["aplay", "-q", "-t", "raw", "-f", "S16_LE", "-c", "1", "-r", str(self.sample_rate), "-"]
 
+    def _start_pipeline(self):
+        """Launches the long-lived Piper and aplay processes. Utterances fall back to one-shot processes if this fails."""
         try:
-            # Pause microphone to prevent hearing itself
-            if self.microphone:
-                self.microphone.pause()
-
-            self._set_playing(True)
-
-            # 1. Generate Audio (Piper)
-            cmd = [
-                self.piper_bin,
-                "-m", self.model_path,
-                "-f", wav_path,
-                "--sentence-silence", str(self.sentence_silence),
-                "--volume", str(self.volume),
-                "--noise-scale", "0.6",
-                "--noise-w-scale", "0.6",
-            ]
-
-            # print(f"🗣️ Piper generating: {text[:20]}...")
-            r = subprocess.run(
-                cmd,
-                input=text.encode("utf-8"),
+            self._piper = subprocess.Popen(
+                self._piper_cmd(),
+                stdin=subprocess.PIPE,
                 stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
             )
+            self._aplay = subprocess.Popen(
+                self._aplay_cmd(),
+                stdin=subprocess.PIPE,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+        except OSError as e:
+            print(f"⚠️ Persistent Piper unavailable ({e}), spawning per utterance")
+            self._stop_pipeline()
+            return
 
-            if r.returncode != 0:
-                print("❌ Piper Failed:", r.stderr.decode("utf-8", errors="ignore"))
+        # An int8 voice this Piper build cannot run makes it exit while loading
+        if self.model_path != self._fp32_model_path:
+            try:
+                self._piper.wait(timeout=INT8_LOAD_CHECK)
+            except subprocess.TimeoutExpired:
+                pass
+            else:
+                self._restart_on_fp32()
                 return
+        threading.Thread(target=self._pump_audio, daemon=True).start()
+
+    def _drop_int8(self):
+        """Switches back to the fp32 voice. False if it was already in use."""
+        if self.model_path == self._fp32_model_path:
+            return False
+        print(f"⚠️ Piper could not run {self.model_path}, using {self._fp32_model_path}")
+        self.model_path = self._fp32_model_path
+        return True
+
+    def _stop_pipeline(self):
+        for proc in (self._piper, self._aplay):
+            if proc is None:
+                continue
+            try:
+                proc.stdin.close()  # EOF lets both drain and exit
+            except OSError:
+                pass
+            try:
+                proc.wait(timeout=1)
+            except subprocess.TimeoutExpired:
+                proc.terminate()
+        self._piper = self._aplay = None
+
+    def _pipeline_alive(self):
+        return (self._piper is not None and self._piper.poll() is None
+                and self._aplay.poll() is None)
+
+    def _pump_audio(self):
+        """Copies Piper's PCM into aplay, keeping a clock of when the handed-over audio will finish."""
+        boost_audio_thread()
+        piper = self._piper
+        bytes_per_sec = self.sample_rate * 2  # S16_LE mono
+        try:
+            while True:
+                chunk = piper.stdout.read1(4096)
+                if not chunk:
+                    break
+                now = time.monotonic()
+                with self._audio_cond:
+                    # interrupt() may have swapped in a fresh aplay
+                    aplay, discard = self._aplay, self._discard_audio
+                    if not discard:
+                        self._play_until = max(self._play_until, now) + len(chunk) / bytes_per_sec
+                    self._last_audio = now
+                    self._audio_chunks += 1
+                    self._audio_cond.notify_all()
+                if discard:
+                    continue
+                try:
+                    aplay.stdin.write(chunk)
+                    aplay.stdin.flush()
+                except (OSError, ValueError):
+                    if aplay is not self._aplay:
+                        continue  # Killed by interrupt() mid-write
+                    raise
+        except (OSError, ValueError):
+            pass
+        with self._audio_cond:
+            self._audio_cond.notify_all()
+
+    # Raw PCM carries no end-of-utterance marker: an utterance is over once Piper has been
+    # silent for AUDIO_QUIET seconds and aplay has played everything it was handed.
+    AUDIO_FIRST_TIMEOUT = 10.0
+    AUDIO_QUIET = 0.25
+
+    def _speak_persistent(self, text):
+        with self._audio_cond:
+            chunks_before = self._audio_chunks
+            self._discard_audio = False
+        self._piper.stdin.write(text.encode("utf-8") + b"\n")
+        self._piper.stdin.flush()
 
-            if not os.path.exists(wav_path) or os.path.getsize(wav_path) == 0:
-                print("❌ Generated WAV is empty.")
+        with self._audio_cond:
+            if not self._audio_cond.wait_for(
+                lambda: self._audio_chunks > chunks_before or not self._pipeline_alive(),
+                timeout=self.AUDIO_FIRST_TIMEOUT,
+            ):
                 return
+            while self._pipeline_alive():
+                now = time.monotonic()
+                remaining = max(self._play_until - now, self._last_audio + self.AUDIO_QUIET - now)
+                if remaining <= 0:
+                    break
+                self._audio_cond.wait(remaining)
 
-            # 2. Play Audio (aplay)
-            r2 = subprocess.run(
-                ["aplay", "-q", wav_path],
+    def _speak_oneshot(self, text, sentence_silence=None):
+        """Streams a fresh Piper's raw PCM straight into aplay, so playback starts with the first sentence."""
+        piper = aplay = None
+        try:
+            piper = subprocess.Popen(
+                self._piper_cmd(sentence_silence),
+                stdin=subprocess.PIPE,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE,
             )
-            if r2.returncode != 0:
-                print("❌ aplay Failed:", r2.stderr.decode("utf-8", errors="ignore"))
+
+            # aplay reads the PCM as Piper produces it
+            aplay = subprocess.Popen(
+                self._aplay_cmd(),
+                stdin=piper.stdout,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+            )
+            piper.stdout.close()  # aplay holds the read end now
+            with self._lock:
+                self._current_procs = (piper, aplay)
+
+            piper.stdin.write(text.encode("utf-8"))
+            piper.stdin.close()
+
+            aplay_err = aplay.stderr.read()
+            if aplay.wait() > 0:  # Negative: killed by interrupt()
+                print("❌ aplay Failed:", aplay_err.decode("utf-8", errors="ignore"))
+            piper_err = piper.stderr.read()
+            if piper.wait() > 0:
+                print("❌ Piper Failed:", piper_err.decode("utf-8", errors="ignore"))
+        finally:
+            with self._lock:
+                self._current_procs = ()
+            for proc in (piper, aplay):
+                if proc and proc.poll() is None:
+                    proc.kill()
+
+    def _restart_on_fp32(self):
+        """Relaunches a persistent Piper that died on the int8 voice with the fp32 one. True if it did."""
+        if self._pipeline_alive() or not self._drop_int8():
+            return False
+        self._stop_pipeline()
+        self._start_pipeline()
+        return True
+
+    def _speak_with_piper(self, text, silence):
+        if self._pipeline_alive():
+            self._speak_persistent(text)
+        else:
+            self._speak_oneshot(text, silence)
+
+    def _speak_one(self, text: str):
+        """Speaks one text through the persistent Piper if it is running, else through one-shot processes."""
+        text = self._normalize_for_piper(text)
+        # The persistent Piper was launched with one silence setting; only one-shot runs can shorten it
+        silence = FIRST_CHUNK_SILENCE if self._first_after_clear else None
+        self._first_after_clear = False
+
+        try:
+            # Pause microphone to prevent hearing itself
+            if self.microphone:
+                self.microphone.pause()
+
+            with self._pipe_lock:
+                self._restart_on_fp32()
+                started_alive = self._pipeline_alive()
+                self._speak_with_piper(text, silence)
+                # The int8 voice died while speaking this very text: say it again on fp32
+                if started_alive and self._restart_on_fp32():
+                    self._speak_with_piper(text, silence)
 
         except Exception as e:
             print(f"Error in speech loop: {e}")
         finally:
-            self._set_playing(False)
             if self.microphone:
                 self.microphone.resume()
-            try:
-                os.remove(wav_path)
-            except OSError:
-                pass
 
     def _play_worker(self):
         """Worker loop that pulls text from queue and speaks it."""
         while True:
-            text = self._queue.get()
+            try:
+                text = self._queue.popleft()
+            except IndexError:
+                self._has_work.clear()
+                if not self._queue:  # Re-check: play_text may have appended before the clear
+                    self._has_work.wait()
+                continue
             if text is None:
-                self._queue.task_done()
                 return
             try:
                 self._speak_one(text)
             finally:
-                self._queue.task_done()
+                self._done()
+
+    def _speak_tracked(self, text):
+        try:
+            self._speak_one(text)
+        finally:
+            self._done()
+
+    def _progressive_chunks(self, text):
+        """Splits text into chunks of 1, 2, 4, ... sentences, so the first one is synthesized fastest."""
+        sentences = [m.group(0) for m in SPEAKER_SENTENCE_RE.finditer(text) if m.group(0).strip()]
+        size = 1
+        while sentences:
+            yield "".join(sentences[:size])
+            sentences = sentences[size:]
+            size *= 2
 
     def play_text(self, text):
-        """Interface used by the main app to queue text."""
-        if isinstance(text, list):
-            for t in text:
+        """Interface used by the main app to queue text (a string, or a list / tuple of them)."""
+        items = text if isinstance(text, (list, tuple)) else (text,)
+        for t in items:
+            for chunk in self._progressive_chunks(t):
+                self._begin()
                 if self._use_queue:
-                    self._queue.put(t)
+                    self._queue.append(chunk)
+                    self._has_work.set()
                 else:
-                    self._speak_one(t) # Blocking fallback
-        else:
-            if self._use_queue:
-                self._queue.put(text)
-            else:
-                threading.Thread(target=self._speak_one, args=(text,), daemon=True).start()
+                    self._speak_tracked(chunk)  # Blocking: callers wanting async use the queue
+
+    def interrupt(self):
+        """Drops every queued chunk and cuts off the one playing, e.g. when the user barges in."""
+        while True:
+            try:
+                text = self._queue.popleft()
+            except IndexError:
+                break
+            if text is None:
+                self._queue.appendleft(None)  # Keep a pending close()
+                break
+            self._done()
+        self._first_after_clear = True
+
+        # One-shot path: its processes hold nothing worth keeping
+        with self._lock:
+            for proc in self._current_procs:
+                proc.kill()
+
+        # Persistent path: Piper keeps its model, the rest of its output is dropped,
+        # and aplay (with the audio already handed to it) is replaced by a fresh one
+        if self._pipeline_alive():
+            try:
+                fresh = subprocess.Popen(
+                    self._aplay_cmd(),
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                )
+            except OSError:
+                return
+            with self._audio_cond:
+                old, self._aplay = self._aplay, fresh
+                self._discard_audio = True
+                self._play_until = time.monotonic()
+                self._audio_cond.notify_all()
+            old.kill()
+            old.wait()
+            try:
+                old.stdin.close()
+            except (OSError, ValueError):
+                pass
 
     def close(self):
         if self._use_queue:
-            self._queue.put(None)
+            self._queue.append(None)
+            self._has_work.set()
+            self._thread.join(timeout=5)
+        with self._pipe_lock:
+            self._stop_pipeline()
 
 # --- MICROPHONE CLASS ---
 
@@ -221,90 +643,501 @@ def ignore_stderr():
         os.dup2(old_stderr, 2)
         os.close(old_stderr)
 
+try:
+    import audioop  # What speech_recognition measures energy with (audioop-lts on 3.13+)
+except ImportError:
+    audioop = None
+
+def pcm16_rms(data):
+    """RMS energy of 16-bit mono PCM, on the same scale as Recognizer.energy_threshold."""
+    if audioop is not None:
+        return audioop.rms(data, 2)
+    samples = memoryview(data).cast("h")
+    if not samples:
+        return 0
+    return int((sum(x * x for x in samples) / len(samples)) ** 0.5)
+
+class VoiceMeterStream:
+    """
+    Wraps a speech_recognition source stream so every chunk recognizer.listen()
+    reads is also checked for energy: voice is reported while the phrase is
+    still being spoken, not only once listen() has returned it. While muted
+    (the speaker is talking) it reads silence, so listen() cannot pick up the
+    assistant's own voice.
+    """
+    def __init__(self, stream, is_muted, is_voice, on_voice):
+        self._stream = stream
+        self._is_muted = is_muted
+        self._is_voice = is_voice
+        self._on_voice = on_voice
+
+    def read(self, size):
+        data = self._stream.read(size)
+        if self._is_muted():
+            return bytes(len(data))
+        if self._is_voice(data):
+            self._on_voice()
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
 class Microphone:
-    def __init__(self):
-        self._queue: queue.Queue[str] = queue.Queue()
+    def __init__(
+        self,
+        # "google": cloud recognition via speech_recognition
+        # "vosk": local streaming recognition (no network round-trip)
+        # "whisper": local streaming faster-whisper (int8 on CPU), words committed as they stabilize
+        backend="google",
+        vosk_model_path=os.path.expanduser("~/vosk/models/vosk-model-small-cn-0.22"),
+        whisper_model="small",
+    ):
+        # Recognized phrases: one producer thread, one reader (see Speaker._queue)
+        self._queue: deque[str] = deque()
+        self._has_text = threading.Event()
         self._stop_event = threading.Event()
         self._pause_event = threading.Event() 
-        
+        self._last_pause_time = 0.0  # When the speaker last started talking
+
+        self.backend = backend
+        self.vosk_model_path = vosk_model_path
+
+        # Voice activity: lets callers stop waiting early on silence, or keep
+        # waiting while a phrase is still being heard / recognized
+        self._last_voice_time = 0.0
+        self._voice_hold = 0.5  # Seconds voice counts as active after the last voiced chunk
+        self._recognizing = threading.Event()
+
+        # Google backend: captured phrases wait here for the recognizer thread,
+        # so capture goes on during the network round-trip
+        self._audio_queue = queue.Queue(maxsize=8)
+        self._recalibrate = threading.Event()
+        self._recognizer = sr.Recognizer() if backend == "google" else None
+
+        # Loaded once up front: the first phrase should not wait for the model
+        self._whisper = None
+        if backend == "whisper":
+            try:
+                from faster_whisper import WhisperModel
+                self._whisper = WhisperModel(whisper_model, device="cpu", compute_type="int8")
+            except ImportError:
+                print("⚠️ [Mic] Error: 'faster-whisper' is not installed, using Google recognition.")
+                self.backend = "google"
+                self._recognizer = sr.Recognizer()
+
+        workers = {"vosk": self._vosk_worker, "whisper": self._whisper_worker}
         self._thread = threading.Thread(
-            target=self._listen_worker,
+            target=workers.get(self.backend, self._listen_worker),
             daemon=True,
         )
         self._thread.start()
 
+        if self.backend == "google":
+            self._recognize_thread = threading.Thread(target=self._recognize_worker, daemon=True)
+            self._recognize_thread.start()
+
     def pause(self):
         """Stop microphone from listening (speaker is talking)."""
+        self._last_pause_time = time.time()
         self._pause_event.set()
 
     def resume(self):
         """Resume microphone listening."""
         self._pause_event.clear()
 
+    def _mark_voice(self):
+        self._last_voice_time = time.time()
+
+    def voice_active(self):
+        """True while the user is talking or a phrase is still being recognized."""
+        return (
+            self._recognizing.is_set()
+            or not self._audio_queue.empty()
+            or time.time() - self._last_voice_time < self._voice_hold
+        )
+
     def _listen_worker(self):
-        recognizer = sr.Recognizer()
+        """Captures phrases and hands them to _recognize_worker."""
+        boost_audio_thread()
+        recognizer = self._recognizer
         
-        # 1. Initialize Microphone (Silenced)
-        # Wrapping this suppresses the "ALSA lib..." logs during init
+        # 1-3. Initialize the Microphone, open its stream once for the whole session
+        # and adjust for ambient noise, all under a single stderr redirect:
+        # ALSA only logs while the device is being opened, never per phrase
+        print("[Mic] Adjusting for ambient noise...")
         try:
             with ignore_stderr():
                 mic = sr.Microphone(device_index=0)
+                source = mic.__enter__()
+                recognizer.adjust_for_ambient_noise(source, duration=1)
         except OSError:
             print("⚠️ [Mic] Error: Device index 0 not found. Check audio settings.")
             return
 
-        # 2. Ambient Noise Adjustment (Silenced)
-        # This opens the stream, which also triggers ALSA logs
-        print("[Mic] Adjusting for ambient noise...")
-        with ignore_stderr():
-            with mic as source:
-                recognizer.adjust_for_ambient_noise(source, duration=1)
+        # Voice activity for voice_active(), using the same
+        # (dynamically adjusted) threshold recognizer.listen starts a phrase at
+        source.stream = VoiceMeterStream(
+            source.stream,
+            self._pause_event.is_set,
+            lambda data: pcm16_rms(data) > recognizer.energy_threshold,
+            self._mark_voice,
+        )
+        # listen() only returns the phrase after pause_threshold of silence: stay
+        # active until then, so the phrase is queued before voice goes inactive
+        self._voice_hold = recognizer.pause_threshold + 0.2
         
         print("[Mic] Listening...")
 
+        try:
+            self._capture_phrases(recognizer, source)
+        finally:
+            mic.__exit__(None, None, None)
+
+    def _capture_phrases(self, recognizer, source):
         while not self._stop_event.is_set():
 
-            # If paused → do nothing but sleep briefly
+            # If paused → keep draining the stream so the speaker's own
+            # voice is not left in the buffer when listening resumes
             if self._pause_event.is_set():
-                time.sleep(0.1)
+                try:
+                    source.stream.read(source.CHUNK)
+                except Exception:
+                    time.sleep(0.1)
                 continue
 
             try:
-                # 3. Listening (Silenced)
-                # 'listen' keeps the stream open
-                with ignore_stderr():
-                    with mic as source:
-                        audio = recognizer.listen(source, timeout=None, phrase_time_limit=10)
+                # 4. Listening
+                audio = recognizer.listen(source, timeout=None, phrase_time_limit=10)
+
+                # A phrase that was still being captured when the speaker started
+                # holds (part of) the assistant's own voice: drop it
+                duration = len(audio.frame_data) / (audio.sample_rate * audio.sample_width)
+                if self._pause_event.is_set() or self._last_pause_time > time.time() - duration:
+                    continue
 
-                # 4. Recognition (No need to silence, this is network/CPU only)
+                # 5. Hand off to the recognizer thread; if it has fallen far
+                # behind, drop the oldest phrase rather than grow without bound
                 try:
-                    # Using zh-TW for Taiwan context
-                    text = recognizer.recognize_google(audio, language="zh-TW")
-                    if text.strip():
-                        # print(f"[Mic] Recognized: {text}")
-                        self._queue.put(text.strip())
-                except sr.UnknownValueError:
-                    pass
-                except sr.RequestError as e:
-                    print(f"[Mic] Network Error: {e}")
+                    self._audio_queue.put_nowait(audio)
+                except queue.Full:
+                    try:
+                        self._audio_queue.get_nowait()
+                    except queue.Empty:
+                        pass
+                    self._audio_queue.put_nowait(audio)
+
+                if self._recalibrate.is_set():
+                    print("[Mic] Re-adjusting for ambient noise...")
+                    recognizer.adjust_for_ambient_noise(source, duration=0.5)
+                    self._recalibrate.clear()
 
             except Exception:
+                # Back off so a dead stream does not spin this (real-time) thread
+                time.sleep(0.1)
                 continue
 
+    def _transcribe(self, audio):
+        """Text of one captured phrase; raises sr.UnknownValueError if there is none."""
+        # Using zh-TW for Taiwan context
+        return self._recognizer.recognize_google(audio, language="zh-TW")
+
+    def _coalesce(self, audio):
+        """Joins phrases that queued up behind `audio` into one clip: one round-trip instead of several."""
+        frames = [audio.get_raw_data()]
+        while True:
+            try:
+                nxt = self._audio_queue.get_nowait()
+            except queue.Empty:
+                break
+            if (nxt.sample_rate, nxt.sample_width) != (audio.sample_rate, audio.sample_width):
+                nxt = sr.AudioData(
+                    nxt.get_raw_data(convert_rate=audio.sample_rate, convert_width=audio.sample_width),
+                    audio.sample_rate, audio.sample_width,
+                )
+            frames.append(nxt.get_raw_data())
+        if len(frames) == 1:
+            return audio
+        return sr.AudioData(b"".join(frames), audio.sample_rate, audio.sample_width)
+
+    def _recognize_worker(self):
+        """Transcribes captured phrases (network/CPU only, no audio device access)."""
+        # Noise that crosses the energy threshold shows up as phrases Google
+        # cannot transcribe; after a couple in a row, recalibrate once.
+        unrecognized_in_a_row = 0
+
+        while not self._stop_event.is_set():
+            try:
+                audio = self._audio_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            audio = self._coalesce(audio)
+
+            self._recognizing.set()
+            try:
+                text = self._transcribe(audio)
+                unrecognized_in_a_row = 0
+                if text.strip():
+                    # print(f"[Mic] Recognized: {text}")
+                    self._queue.append(text.strip())
+                    self._has_text.set()
+            except sr.UnknownValueError:
+                unrecognized_in_a_row += 1
+            except sr.RequestError as e:
+                print(f"[Mic] Network Error: {e}")
+            except Exception:
+                pass
+            finally:
+                self._recognizing.clear()
+
+            if unrecognized_in_a_row >= 2:
+                self._recalibrate.set()
+                unrecognized_in_a_row = 0
+
+    def _vosk_worker(self):
+        """Feeds raw 16 kHz audio to Vosk; phrases are queued as soon as Vosk finalizes them."""
+        try:
+            import pyaudio
+            from vosk import Model, KaldiRecognizer
+        except ImportError:
+            print("⚠️ [Mic] Error: 'vosk' and 'pyaudio' are required for the vosk backend.")
+            return
+
+        if not os.path.exists(self.vosk_model_path):
+            print(f"⚠️ [Mic] Error: Vosk model not found at {self.vosk_model_path}")
+            return
+
+        try:
+            import webrtcvad
+            vad = webrtcvad.Vad(2)
+        except ImportError:
+            vad = None  # voice_active() then only reflects Vosk's partial results
+
+        rate = 16000
+        chunk = 1920  # 120 ms per read = 4 VAD frames of 30 ms
+        vad_frame_bytes = 480 * 2
+        recognizer = KaldiRecognizer(Model(self.vosk_model_path), rate)
+
+        with ignore_stderr():
+            audio = pyaudio.PyAudio()
+            stream = audio.open(
+                format=pyaudio.paInt16, channels=1, rate=rate,
+                input=True, input_device_index=0, frames_per_buffer=chunk,
+            )
+
+        print("[Mic] Listening (Vosk)...")
+
+        try:
+            while not self._stop_event.is_set():
+                data = stream.read(chunk, exception_on_overflow=False)
+
+                # While the speaker talks, drop the audio (and any half-heard phrase)
+                if self._pause_event.is_set():
+                    recognizer.Reset()
+                    continue
+
+                if vad:
+                    for i in range(0, len(data), vad_frame_bytes):
+                        if vad.is_speech(data[i:i + vad_frame_bytes], rate):
+                            self._last_voice_time = time.time()
+                            break
+
+                if recognizer.AcceptWaveform(data):
+                    self._recognizing.clear()
+                    # The Chinese model separates words with spaces
+                    text = json.loads(recognizer.Result()).get("text", "").replace(" ", "")
+                    if text:
+                        self._queue.append(text)
+                        self._has_text.set()
+                elif json.loads(recognizer.PartialResult()).get("partial"):
+                    self._recognizing.set()  # A phrase has started but is not final yet
+        finally:
+            stream.stop_stream()
+            stream.close()
+            audio.terminate()
+
+    # Streaming Whisper: the audio since the last committed word is re-transcribed every
+    # WHISPER_STEP seconds; words two consecutive passes agree on are committed
+    # (LocalAgreement-2) and cut from the buffer.
+    WHISPER_STEP = 1.0
+    WHISPER_MAX_BUFFER = 30  # Seconds, Whisper's window
+    WHISPER_KEEP_TAIL = 15  # Seconds kept when the buffer overflows
+    WHISPER_END_SILENCE = 0.8  # Silence that ends a phrase
+    WHISPER_VOICE_RMS = 0.01  # Float sample RMS counted as voice (without webrtcvad)
+    WHISPER_SILENCE_DROP = 0.4  # Silence inside a phrase kept in the buffer
+
+    def _whisper_words(self, audio, offset, prompt):
+        """(start, end, word) tuples of one pass, in stream time."""
+        segments, _ = self._whisper.transcribe(
+            audio, language="zh", beam_size=1, vad_filter=True,
+            word_timestamps=True, initial_prompt=prompt or None,
+        )
+        return [
+            (offset + w.start, offset + w.end, w.word.strip())
+            for segment in segments for w in segment.words if w.word.strip()
+        ]
+
+    def _whisper_worker(self):
+        """Streams 16 kHz audio through faster-whisper and queues each phrase once the user goes quiet."""
+        try:
+            import pyaudio
+            import numpy
+        except ImportError:
+            print("⚠️ [Mic] Error: 'pyaudio' and 'numpy' are required for the whisper backend.")
+            return
+
+        try:
+            import webrtcvad
+            vad = webrtcvad.Vad(2)
+        except ImportError:
+            vad = None  # Voice is then an RMS threshold
+
+        rate = 16000
+        chunk = 1600  # 100 ms per read
+        vad_frame_bytes = 480 * 2  # 30 ms
+        buffer = numpy.zeros(self.WHISPER_MAX_BUFFER * rate, numpy.float32)
+        filled = 0
+        buffer_start = 0.0  # Stream time of buffer[0]
+        committed = []  # Words of the current phrase
+        committed_end = 0.0
+        previous = []  # Uncommitted words of the last pass
+        since_step = 0
+        heard = False  # Voice since the last phrase ended
+
+        def cut(until):
+            # Drops the audio before stream time `until`
+            nonlocal filled, buffer_start
+            n = min(filled, max(0, int((until - buffer_start) * rate)))
+            buffer[:filled - n] = buffer[n:filled]
+            filled -= n
+            buffer_start += n / rate
+
+        # PortAudio's callback thread only appends here, so capture never stalls
+        # while a pass is transcribing; the worker takes whatever has arrived
+        arrived_chunks = deque(maxlen=self.WHISPER_MAX_BUFFER * rate // chunk)
+        arrived = threading.Event()
+
+        def on_audio(data, frame_count, time_info, status):
+            arrived_chunks.append(data)
+            arrived.set()
+            return (None, pyaudio.paContinue)
+
+        with ignore_stderr():
+            audio = pyaudio.PyAudio()
+            stream = audio.open(
+                format=pyaudio.paInt16, channels=1, rate=rate,
+                input=True, input_device_index=0, frames_per_buffer=chunk,
+                stream_callback=on_audio,
+            )
+
+        print("[Mic] Listening (Whisper)...")
+
+        try:
+            while not self._stop_event.is_set():
+                if not arrived_chunks:
+                    arrived.clear()
+                    if not arrived_chunks:  # Re-check: the callback may have appended before the clear
+                        arrived.wait(0.5)
+                    continue
+                data = b"".join(arrived_chunks.popleft() for _ in range(len(arrived_chunks)))
+                samples = numpy.frombuffer(data, dtype=numpy.int16).astype(numpy.float32) / 32768.0
+
+                # While the speaker talks, drop the audio (and any half-heard phrase)
+                if self._pause_event.is_set():
+                    buffer_start += (filled + len(samples)) / rate
+                    filled = since_step = 0
+                    committed, previous = [], []
+                    heard = False
+                    self._recognizing.clear()
+                    continue
+
+                if vad:
+                    voiced = any(
+                        vad.is_speech(data[i:i + vad_frame_bytes], rate)
+                        for i in range(0, len(data) - vad_frame_bytes + 1, vad_frame_bytes)
+                    )
+                else:
+                    voiced = float(numpy.sqrt(numpy.mean(samples * samples))) >= self.WHISPER_VOICE_RMS
+                if voiced:
+                    self._last_voice_time = time.time()
+                    heard = True
+                elif time.time() - self._last_voice_time > self.WHISPER_SILENCE_DROP:
+                    # A pause is not buffered past its first moments: the buffer (and
+                    # every pass over it) grows with speech, not with wall-clock time
+                    samples = samples[:0]
+
+                if filled + len(samples) > len(buffer):
+                    if previous:
+                        committed += [w[2] for w in previous]  # About to lose their audio
+                        committed_end = previous[-1][1]
+                        previous = []
+                    cut(max(committed_end, buffer_start + (filled - self.WHISPER_KEEP_TAIL * rate) / rate))
+                buffer[filled:filled + len(samples)] = samples
+                filled += len(samples)
+                since_step += len(samples)
+
+                silent = time.time() - self._last_voice_time >= self.WHISPER_END_SILENCE
+                if silent and not heard:
+                    cut(buffer_start + filled / rate)  # Nothing being said: keep no audio
+                    since_step = 0
+                    continue
+
+                if silent:
+                    # Phrase over: everything the final pass hears is committed
+                    words = self._whisper_words(buffer[:filled], buffer_start, "".join(committed))
+                    committed += [w[2] for w in words if w[0] >= committed_end - 0.05]
+                    text = "".join(committed)
+                    if text:
+                        self._queue.append(text)
+                        self._has_text.set()
+                    cut(buffer_start + filled / rate)
+                    committed, previous = [], []
+                    since_step = 0
+                    heard = False
+                    self._recognizing.clear()
+                    continue
+
+                if since_step < self.WHISPER_STEP * rate:
+                    continue
+                since_step = 0
+                self._recognizing.set()
+
+                words = self._whisper_words(buffer[:filled], buffer_start, "".join(committed))
+                current = [w for w in words if w[0] >= committed_end - 0.05]
+                agreed = 0
+                while (agreed < min(len(current), len(previous))
+                       and current[agreed][2] == previous[agreed][2]):
+                    agreed += 1
+                if agreed:
+                    committed += [w[2] for w in current[:agreed]]
+                    committed_end = current[agreed - 1][1]
+                    cut(committed_end)
+                previous = current[agreed:]
+        finally:
+            stream.stop_stream()
+            stream.close()
+            audio.terminate()
+
     def has_text(self):
-        return not self._queue.empty()
+        return bool(self._queue)
+
+    def read_text(self, timeout=None):
+        """
+        Returns every queued phrase joined into one string ("" if there is none).
+        With a timeout, blocks up to that long for the first phrase to arrive.
+        """
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+            while not self._queue:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._has_text.clear()
+                if not self._queue:  # Re-check: a phrase may have landed before the clear
+                    self._has_text.wait(remaining)
 
-    def read_text(self):
         messages = []
-        try:
-            # Loop strictly to drain the queue
-            while True:
-                # get_nowait raises queue.Empty immediately if nothing is there
-                msg = self._queue.get_nowait()
-                messages.append(msg)
-                self._queue.task_done()
-        except queue.Empty:
-            pass # Queue is empty, loop finished
+        while self._queue:
+            messages.append(self._queue.popleft())
             
         # Join all separate phrases into one string (e.g. "Yes" + "I am ready")
         return " ".join(messages)
@@ -318,8 +1151,7 @@ if __name__ == "__main__":
         speaker.play_text("測試成功，語音系統正常。")
 
         # Wait for audio to finish
-        while speaker.is_playing():
-            time.sleep(0.1)
+        speaker.wait_idle()
 
         print("✅ Done.")
 
@@ -1,4 +1,8 @@
-import base64
+try:
+    import pybase64 as base64  # SIMD-accelerated, same API as the stdlib module
+except ImportError:
+    import base64
+import os
 import time
 import threading
 import queue
@@ -7,21 +11,39 @@ class Camera:
     def __init__(self):
         # Ensure you have a file named 'test_image.jpg' in the same directory
         self.image_path = "images.jfif"
+        self._buffer = bytearray()  # Reused by every read, grown only for a larger file
+        self._cache_key = None  # (mtime_ns, size) of the file behind self._cache
+        self._cache = None
 
     def capture(self) -> str:
         try:
             with open(self.image_path, "rb") as image_file:
-                # Read binary file and encode to base64 string
+                st = os.fstat(image_file.fileno())
+                key = (st.st_mtime_ns, st.st_size)
+                if key == self._cache_key:
+                    print(f"[Mock Camera] Captured {self.image_path}")
+                    return self._cache
+                size = st.st_size
+                if len(self._buffer) < size:
+                    self._buffer = bytearray(size)
+                data = memoryview(self._buffer)[:size]
+                data = data[:image_file.readinto(data)]
+                # Encode straight from the reused buffer, no per-capture bytes copy
                 print(f"[Mock Camera] Captured {self.image_path}")
-                return base64.b64encode(image_file.read()).decode('utf-8')
+                self._cache = base64.b64encode(data).decode('ascii')
+                self._cache_key = key
+                return self._cache
         except FileNotFoundError:
             print(f"[Mock Camera] Error: '{self.image_path}' not found. Please place an image file in the directory.")
             return None
 
+    def release(self):
+        pass
+
 
 class Speaker:
 
-    def __init__(self):
+    def __init__(self, microphone=None):
         pass
 
     def play_text(self, text):
@@ -31,6 +53,12 @@ class Speaker:
     def is_playing(self) -> bool:
         return False
 
+    def wait_idle(self, timeout=None):
+        return True
+
+    def interrupt(self):
+        pass
+
 
 class Microphone:
     def __init__(self):
@@ -50,11 +78,22 @@ class Microphone:
             except EOFError:
                 break
 
+    def pause(self):
+        pass
+
+    def resume(self):
+        pass
+
     def has_text(self) -> bool:
         return not self.input_queue.empty()
 
-    def read_text(self) -> str:
+    def voice_active(self) -> bool:
+        return False
+
+    def read_text(self, timeout=None) -> str:
         try:
+            if timeout is not None:
+                return self.input_queue.get(timeout=timeout)
             return self.input_queue.get_nowait()
         except queue.Empty:
             return ""
\ No newline at end of file